@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+import lowpoly
+from lowpoly import MODES, draw_mode
+
+'''
+This file contains the benchmark harness. Every gui mode is run on the
+sample images at several settings and resolutions, stage functions of
+lowpoly are timed separately, results are written as json and compared
+against a stored baseline to flag regressions
+'''
+
+IMAGES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "doc", name) \
+            for name in ["lenna.jpg", "jake.jpg", "vincent.jpg", "irisi.jpg", "wave.png"]]
+
+# lowpoly functions timed per run, times are inclusive of nested stages
+STAGES = ["sobel", "cull_sobel", "cull_points", "greyscale_points", \
+            "poisson_points", "refine_stage", "build_subdiv", "make_voronoi", \
+            "triangulate", "euclidean_mst", "associate_polygon_with_color", \
+            "write_file"]
+
+# (density, threshold) of point based modes, grid size of grid based modes
+POINT_SETTINGS = [(2, 100), (5, 50), (10, 100)]
+GRID_SETTINGS = [5, 10, 20]
+
+
+# benchmark cases of every gui mode
+# return list of tuple (mode, draw_mode parameters)
+def bench_cases(quick=0):
+    cases = []
+    points = POINT_SETTINGS[:1] if quick else POINT_SETTINGS
+    grids = GRID_SETTINGS[1:2] if quick else GRID_SETTINGS
+    for mode in MODES:
+        if mode in ("Delaunay", "Voronoi", "Random-Tree"):
+            for cull_pts, cull_sbl in points:
+                cases.append((mode, dict(cull_pts=cull_pts, cull_sbl=cull_sbl)))
+            cases.append((mode, dict(cull_pts=points[0][0], \
+                                    cull_sbl=points[0][1], poisson=1)))
+            if mode != "Random-Tree":
+                cases.append((mode, dict(budget=4000)))
+            if mode != "Voronoi":
+                cases.append((mode, dict(grey_weighted=1)))
+        elif mode == "Ortho-Tree":
+            for dist in grids:
+                cases.append((mode, dict(dist=dist, cull_pts=points[0][0], \
+                                        cull_sbl=points[0][1])))
+        else:
+            for dist in grids:
+                cases.append((mode, dict(dist=dist)))
+            cases.append((mode, dict(dist=grids[0], merge=4)))
+    return cases
+
+
+# replaces stage functions of lowpoly by timed versions while active
+class StageTimer:
+    def __init__(self, stages=STAGES):
+        self.stages = stages
+        self.originals = {}
+        self.reset()
+
+    def reset(self):
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.calls = dict.fromkeys(self.stages, 0)
+
+    def timed(self, stage, function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+        return wrapper
+
+    def __enter__(self):
+        for stage in self.stages:
+            self.originals[stage] = getattr(lowpoly, stage)
+            setattr(lowpoly, stage, self.timed(stage, self.originals[stage]))
+        return self
+
+    def __exit__(self, *exc):
+        for stage, function in self.originals.items():
+            setattr(lowpoly, stage, function)
+        self.originals = {}
+
+    # stage times of the last run, stages not called are left out
+    def result(self):
+        return {stage: dict(seconds=round(self.seconds[stage], 6), \
+                            calls=self.calls[stage]) \
+                for stage in self.stages if self.calls[stage]}
+
+
+# write image resized by scale into directory
+# return path of written image
+def scaled_image(path, scale, directory):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if scale == 1:
+        return path, name
+    image = cv2.imread(path)
+    if image is None:
+        raise IOError("could not read " + path)
+    image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+    name = "%s@%gx" % (name, scale)
+    scaled = os.path.join(directory, name + ".png")
+    cv2.imwrite(scaled, image)
+    return scaled, name
+
+
+# run one case, peak traced memory of one run and best time of repeat runs
+# the memory run comes first and doubles as warm up
+# return dict of run results
+def run_case(timer, input, mode, params, out_dir, repeat=1, memory=1):
+    run = {}
+    if memory:
+        # tracing slows numpy and python code, so memory gets its own run
+        tracemalloc.start()
+        name = draw_mode(input, mode, seed=0, out_dir=out_dir, **params)
+        run["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        os.remove(name)
+    best = None
+    for _ in range(repeat):
+        timer.reset()
+        start = time.perf_counter()
+        name = draw_mode(input, mode, seed=0, out_dir=out_dir, **params)
+        total = time.perf_counter() - start
+        if best is None or total < best[0]:
+            best = (total, timer.result())
+    run.update(seconds=round(best[0], 6), stages=best[1], \
+                output_bytes=os.path.getsize(name))
+    os.remove(name)
+    return run
+
+
+# key identifying a run across benchmark files
+def run_key(run):
+    return "%s %s %s" % (run["image"], run["mode"], \
+                        json.dumps(run["params"], sort_keys=True))
+
+
+# compare runs against baseline runs of the same key
+# a value regresses when it grew by more than tolerance (relative)
+# and, for times, by more than min_seconds
+# return list of regression messages
+def compare(runs, baseline, tolerance=0.2, min_seconds=0.02):
+    previous = {run_key(run): run for run in baseline}
+    messages = []
+
+    def check(key, what, new, old, absolute):
+        if old is not None and new > old * (1 + tolerance) and new - old > absolute:
+            messages.append("%s: %s %.4g -> %.4g (%+.0f%%)" % \
+                            (key, what, old, new, (new / old - 1) * 100 if old else 0))
+
+    for run in runs:
+        key = run_key(run)
+        old = previous.get(key)
+        if old is None:
+            continue
+        check(key, "seconds", run["seconds"], old["seconds"], min_seconds)
+        for stage, value in run["stages"].items():
+            if stage in old["stages"]:
+                check(key, stage, value["seconds"], old["stages"][stage]["seconds"], \
+                        min_seconds)
+        if "peak_bytes" in run and "peak_bytes" in old:
+            check(key, "peak_bytes", run["peak_bytes"], old["peak_bytes"], 1 << 20)
+    return messages
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every mode and " \
+                                        "stage on the sample images")
+    parser.add_argument("images", nargs="*", default=IMAGES)
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 2], \
+                        help="resolutions relative to the input images")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--repeat", type=int, default=1, \
+                        help="runs per case, best time is kept")
+    parser.add_argument("--quick", action="store_true", \
+                        help="one setting per mode")
+    parser.add_argument("--no-memory", action="store_true", \
+                        help="skip the traced run measuring peak memory")
+    parser.add_argument("-o", "--output", default="bench.json")
+    parser.add_argument("--baseline", default=None, \
+                        help="earlier json output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, \
+                        help="relative growth counted as regression")
+    parser.add_argument("--min-seconds", type=float, default=0.02, \
+                        help="ignore time changes smaller than this")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cases = [case for case in bench_cases(args.quick) if case[0] in args.modes]
+    runs = []
+    work_dir = tempfile.mkdtemp(prefix="voronector-bench-")
+    try:
+        with StageTimer() as timer:
+            for path in args.images:
+                for scale in args.scales:
+                    input, image = scaled_image(path, scale, work_dir)
+                    shape = cv2.imread(input).shape
+                    for mode, params in cases:
+                        run = dict(image=image, width=shape[1], height=shape[0], \
+                                    mode=mode, params=params)
+                        run.update(run_case(timer, input, mode, params, work_dir, \
+                                            args.repeat, not args.no_memory))
+                        runs.append(run)
+                        print("%8.3fs  %-12s %-14s %s" % (run["seconds"], image, \
+                                mode, json.dumps(params, sort_keys=True)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = dict(python=platform.python_version(), numpy=np.__version__, \
+                    opencv=cv2.__version__, machine=platform.machine(), \
+                    created=time.strftime("%Y-%m-%dT%H:%M:%S"), runs=runs)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=1)
+    print("%d runs written to %s" % (len(runs), args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["runs"]
+        messages = compare(runs, baseline, args.tolerance, args.min_seconds)
+        for message in messages:
+            print("REGRESSION " + message)
+        print("%d regressions against %s" % (len(messages), args.baseline))
+        return 1 if messages else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
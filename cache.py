@@ -0,0 +1,109 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+from polygons import PolygonSet
+
+'''
+This file contains the content addressed cache for intermediate pipeline stages
+'''
+
+
+# sha1 hex digest of bytes, used to address decoded images by their content
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+# rough memory footprint of a stage result in bytes
+# counts ndarray and PolygonSet buffers and walks nested lists, tuples
+# and dicts
+def value_size(value):
+    if isinstance(value, (np.ndarray, PolygonSet)):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(value_size(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(value_size(k) + value_size(v) \
+                                            for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+# LRU cache of stage results keyed by stage name and stage parameters
+# keys should include the key of upstream stage (e.g. image content hash)
+# so changing a downstream parameter reuses every upstream result
+# least recently used entries beyond max_bytes are dropped,
+# or pickled into spill_dir if given and loaded back on demand
+# safe to share between threads, e.g. gui worker threads
+class StageCache:
+
+    def __init__(self, max_bytes=512 << 20, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    # stable key of a stage and its parameters
+    def key(self, stage, params):
+        return stage + "-" + content_hash(repr(params).encode())
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, key + ".pkl")
+
+    def __contains__(self, key):
+        if key in self.entries:
+            return True
+        return bool(self.spill_dir) and os.path.exists(self.spill_path(key))
+
+    # return cached value or raise KeyError
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            if self.spill_dir and os.path.exists(self.spill_path(key)):
+                with open(self.spill_path(key), 'rb') as file:
+                    value = pickle.load(file)
+                self.put(key, value)
+                return value
+        raise KeyError(key)
+
+    def put(self, key, value):
+        size = value_size(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_key, (old_value, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+                if self.spill_dir and not os.path.exists(self.spill_path(old_key)):
+                    with open(self.spill_path(old_key), 'wb') as file:
+                        pickle.dump(old_value, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # return cached result of stage with params, computing it on a miss
+    def cached(self, stage, params, compute):
+        key = self.key(stage, params)
+        try:
+            value = self.get(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,191 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from lowpoly import MODES, draw_mode
+from tiled import draw_tiled
+from raster import RASTER_FORMATS
+
+'''
+This file contains headless command line entry for batch conversion
+'''
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+
+# expand files, directories and glob patterns into a sorted list of images
+def collect_images(inputs):
+    images = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = [os.path.join(item, f) for f in os.listdir(item)]
+        elif glob.has_magic(item):
+            paths = glob.glob(item)
+        else:
+            images.append(item)
+            continue
+        images.extend(sorted(p for p in paths \
+                        if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS)))
+    # same image given twice, e.g. by name and by glob, is converted once
+    return list(dict.fromkeys(os.path.normpath(image) for image in images))
+
+
+# images of different directories sharing a name, e.g. a/x.jpg and b/x.png,
+# would be written to the same output, output_name keeps only the name
+# return list of lists of colliding images
+def name_collisions(images):
+    names = {}
+    for image in images:
+        names.setdefault(os.path.basename(image).split('.')[0], []).append(image)
+    return [same for same in names.values() if len(same) > 1]
+
+
+TILED_MODES = ("Delaunay", "Voronoi")
+TILED_PARAMS = ("frame", "boundry", "grey_weighted", "weighted", "poisson", \
+                "seed", "color_mode", "precision", "compress", "group", "quantize", \
+                "merge", "out_dir", "skip_existing")
+
+
+# convert a single image in worker process, tiled if tile > 0
+# jobs is the number of processes tiles are spread over
+# return tuple (input, output, seconds, error)
+def convert_one(input, mode, params, tile=0, jobs=1):
+    start = time.perf_counter()
+    try:
+        if tile and mode in TILED_MODES:
+            name = draw_tiled(input, mode.lower(), tile=tile, \
+                                cull_pts_perct=params["cull_pts"], \
+                                cull_sbl_perct=params["cull_sbl"], jobs=jobs, \
+                                **{k: params[k] for k in TILED_PARAMS})
+        else:
+            name = draw_mode(input, mode, **params)
+    except Exception as e:
+        return (input, None, time.perf_counter() - start, repr(e))
+    return (input, name, time.perf_counter() - start, None)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convert raster images " \
+                                        "to stylized svg without gui")
+    parser.add_argument("inputs", nargs="+", \
+                        help="image files, directories or glob patterns")
+    parser.add_argument("-m", "--mode", default="Delaunay", choices=MODES)
+    parser.add_argument("-o", "--out-dir", default=".", \
+                        help="directory for output svg (default: current)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), \
+                        help="worker processes (default: cpu count)")
+    parser.add_argument("--overwrite", action="store_true", \
+                        help="convert even if output already exists")
+    parser.add_argument("--density", type=int, default=2, \
+                        help="percentage of edge points kept")
+    parser.add_argument("--threshold", type=int, default=100, \
+                        help="sobel threshold in [0 - 255]")
+    parser.add_argument("--grid-size", type=int, default=10)
+    parser.add_argument("--skew", type=int, default=0)
+    parser.add_argument("--pin-frame", action="store_true")
+    parser.add_argument("--edge-only", action="store_true")
+    parser.add_argument("--grey-weighted", action="store_true")
+    parser.add_argument("--weighted", action="store_true", \
+                        help="sample edge points by gradient magnitude")
+    parser.add_argument("--poisson", action="store_true", \
+                        help="space points as blue noise, dense at edges " \
+                        "(or dark areas with --grey-weighted)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--budget", type=int, default=0, \
+                        help="refine Delaunay/Voronoi points by color error " \
+                        "up to about this many polygons, instead of density")
+    parser.add_argument("--max-error", type=float, default=0, \
+                        help="refine Delaunay/Voronoi points until the rms " \
+                        "color error is at most this, instead of density")
+    parser.add_argument("--color-mode", default="center", \
+                        choices=["center", "box", "mean", "rms"])
+    parser.add_argument("--precision", type=int, default=None, \
+                        help="decimals of svg coordinates")
+    parser.add_argument("--svgz", action="store_true", \
+                        help="write gzip compressed svg")
+    parser.add_argument("--output", default="svg", \
+                        choices=["svg"] + list(RASTER_FORMATS), \
+                        help="output format, raster formats are rendered directly")
+    parser.add_argument("--scale", type=float, default=1.0, \
+                        help="size of raster output relative to input")
+    parser.add_argument("--antialias", action="store_true", \
+                        help="anti-aliased raster output")
+    parser.add_argument("--group", action="store_true", \
+                        help="one <path> per fill color")
+    parser.add_argument("--quantize", type=int, default=1, \
+                        help="fill color quantization step for --group")
+    parser.add_argument("--merge", type=int, default=0, \
+                        help="join neighbouring polygons whose fill colors " \
+                        "round to the same multiple of this, 1 joins equal fills")
+    parser.add_argument("--tile", type=int, default=0, \
+                        help="process Delaunay/Voronoi in tiles of this size, " \
+                        "for very large images (svg output only)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    images = collect_images(args.inputs)
+    if not images:
+        print("No image found")
+        return 1
+    collisions = name_collisions(images)
+    if collisions:
+        for same in collisions:
+            print("Same output name for " + ", ".join(same))
+        print("convert these into different --out-dir")
+        return 1
+    os.makedirs(args.out_dir, exist_ok=True)
+    existing = set(os.listdir(args.out_dir))
+    if args.tile and (args.budget or args.max_error):
+        print("--budget and --max-error work on whole images, not with --tile")
+        return 1
+    if args.tile and args.output != "svg":
+        print("--tile writes svg only, not --output " + args.output)
+        return 1
+    params = dict(cull_pts=args.density, cull_sbl=args.threshold, \
+                    dist=args.grid_size, skew=args.skew, \
+                    frame=int(args.pin_frame), boundry=int(args.edge_only), \
+                    grey_weighted=int(args.grey_weighted), \
+                    weighted=int(args.weighted), poisson=int(args.poisson), \
+                    seed=args.seed, \
+                    color_mode=args.color_mode, budget=args.budget, \
+                    max_error=args.max_error, group=int(args.group), \
+                    quantize=args.quantize, merge=args.merge, \
+                    precision=args.precision, compress=int(args.svgz), \
+                    output=args.output, \
+                    scale=args.scale, antialias=int(args.antialias), \
+                    out_dir=args.out_dir, \
+                    skip_existing=int(not args.overwrite))
+
+    start = time.perf_counter()
+    converted = skipped = failed = 0
+    jobs = max(1, min(args.jobs, len(images)))
+    tile_jobs = 1
+    # tiled images are converted one after another, their tiles in parallel
+    if args.tile and args.mode in TILED_MODES:
+        jobs, tile_jobs = 1, max(1, args.jobs)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(convert_one, image, args.mode, params, args.tile, \
+                                tile_jobs) for image in images]
+        for future in as_completed(futures):
+            input, name, seconds, error = future.result()
+            if error:
+                failed += 1
+                print("%8.3fs  FAILED   %s  %s" % (seconds, input, error))
+            elif not args.overwrite and os.path.basename(name) in existing:
+                skipped += 1
+                print("%8.3fs  skipped  %s -> %s" % (seconds, input, name))
+            else:
+                converted += 1
+                print("%8.3fs  done     %s -> %s" % (seconds, input, name))
+    print("%d converted, %d skipped, %d failed in %.3fs with %d jobs" % \
+            (converted, skipped, failed, time.perf_counter() - start, \
+            max(jobs, tile_jobs)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
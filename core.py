@@ -0,0 +1,144 @@
+import io
+from dataclasses import dataclass
+from typing import Optional
+import cv2
+import numpy as np
+import lowpoly
+from cache import content_hash
+from svg import write_stream
+from raster import encode_raster
+from merge import merge_polygons
+from tracing import traced
+
+'''
+This file contains the in memory api. convert takes a decoded image array
+or encoded image bytes with a Params object and returns a Result holding
+points, colored shapes and their svg or raster bytes, nothing is read
+from or written to disk. The file based draw_* functions of lowpoly wrap
+it. Only the pipeline modules are imported, never the gui or PyQt5
+'''
+
+
+# parameters of a conversion, names and defaults as in draw_mode
+# merge joins neighbouring polygons whose colors round to the same
+# multiple of it, 0 keeps every polygon
+# output is "svg" or a raster format extension (png, jpg ...)
+@dataclass
+class Params:
+    mode: str = "Delaunay"
+    cull_pts: int = 2
+    cull_sbl: int = 100
+    dist: int = 10
+    skew: int = 0
+    frame: int = 0
+    boundry: int = 0
+    grey_weighted: int = 0
+    weighted: int = 0
+    poisson: int = 0
+    seed: Optional[int] = None
+    color_mode: str = "center"
+    budget: int = 0
+    max_error: float = 0.0
+    group: int = 0
+    quantize: int = 1
+    merge: int = 0
+    precision: Optional[int] = None
+    compress: int = 0
+    output: str = "svg"
+    scale: float = 1.0
+    antialias: int = 0
+
+
+# outcome of a conversion
+# points    (N, 2) int array of points the shapes were built from
+# polygons  colored PolygonSet, None for tree modes
+# lines     list of tuple (color, line) of tree modes, otherwise None
+class Result:
+    def __init__(self, width, height, points, polygons=None, lines=None, \
+                    params=None):
+        self.width = width
+        self.height = height
+        self.points = points
+        self.polygons = polygons
+        self.lines = lines
+        self.params = params or Params()
+
+    # (N, 3) uint8 rgb of every polygon, or of every line
+    @property
+    def colors(self):
+        if self.polygons is not None:
+            return self.polygons.colors
+        return np.array([color for color, _ in self.lines], dtype=np.uint8).reshape(-1, 3)
+
+    # write output of params into binary stream, stream is left open
+    def write(self, stream):
+        p = self.params
+        if p.output == "svg":
+            write_stream(stream, self.width, self.height, polygons=self.polygons, \
+                            lines=self.lines, boundry=p.boundry, \
+                            precision=p.precision, compress=p.compress, \
+                            group=p.group, quantize=p.quantize)
+        else:
+            stream.write(encode_raster(self.width, self.height, self.polygons, \
+                                        self.lines, p.output, p.scale, \
+                                        p.antialias, p.boundry))
+
+    # return bytes of output of params, svg (gzip if compress) or raster
+    def data(self):
+        stream = io.BytesIO()
+        self.write(stream)
+        return stream.getvalue()
+
+    # write output of params to file name
+    def save(self, name):
+        p = self.params
+        lowpoly.write_output(name, self.width, self.height, polygons=self.polygons, \
+                                lines=self.lines, output=p.output, boundry=p.boundry, \
+                                precision=p.precision, compress=p.compress, \
+                                group=p.group, quantize=p.quantize, scale=p.scale, \
+                                antialias=p.antialias)
+        return name
+
+
+# decoded BGR image of an ndarray or of encoded image bytes
+# with cache, decoded bytes are cached by content hash like load_image
+# return (image, key), key addresses image content for downstream stages
+def decode_image(image, cache=None, key=None):
+    if isinstance(image, np.ndarray):
+        return image, key
+    data = bytes(image)
+
+    def decode():
+        decoded = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if decoded is None:
+            raise ValueError("could not decode image")
+        return decoded
+
+    if cache is None:
+        return decode(), key
+    key = content_hash(data)
+    return cache.cached("image", key, decode), key
+
+
+# convert image array or encoded image bytes with params
+# key addresses image content in cache, as returned by load_image
+# return Result
+@traced("convert")
+def convert(image, params=None, cache=None, progress=None, key=None):
+    params = params or Params()
+    image, key = decode_image(image, cache, key)
+    kind, arguments = lowpoly.mode_arguments(params.mode, params.cull_pts, \
+                            params.cull_sbl, params.dist, params.skew, params.frame, \
+                            params.grey_weighted, params.weighted, params.seed, \
+                            params.color_mode, params.poisson, params.budget, \
+                            params.max_error)
+    points, shapes = lowpoly.SHAPE_FUNCTIONS[kind](image, key=key, cache=cache, \
+                            progress=progress, with_points=1, **arguments)
+    height, width = image.shape[:2]
+    if kind == "tree":
+        return Result(width, height, points, lines=shapes, params=params)
+    # edge only output keeps the outline of every polygon
+    if params.merge and not params.boundry:
+        lowpoly.report(progress, "merging")
+        shapes = merge_polygons(shapes, params.merge)
+    return Result(width, height, points, polygons=shapes, params=params)
@@ -9,14 +9,107 @@ from PyQt5.QtWidgets import (
     QLabel,
 )
 from PyQt5 import QtSvg, QtCore
-from PyQt5.QtGui import QPixmap
+from PyQt5.QtGui import QPixmap, QImageReader, QPainter, QPolygonF, QColor, QPen
+import os
+import shutil
+import tempfile
+import threading
 from lowpoly import *
+from cache import StageCache
 
 '''
 Author: Peiyi Hou
 This file contains all gui components
 '''
 
+# longer side of downscaled image used for live preview, in pixels
+PREVIEW_SIZE = 320
+# smallest grid size used for preview of grids and ortho tree, in pixels
+PREVIEW_MIN_DIST = 3
+
+
+# paint colored polygons and lines straight into a QPixmap
+# shapes are in image coordinates, scaled by scale onto the pixmap
+# return QPixmap
+def paint_shapes(width, height, polygons=None, lines=None, scale=1.0, boundry=0):
+    pixmap = QPixmap(max(1, int(width*scale)), max(1, int(height*scale)))
+    pixmap.fill(QColor(254, 254, 254))
+    painter = QPainter(pixmap)
+    painter.scale(scale, scale)
+    if isinstance(polygons, PolygonSet):
+        polygons = polygons.shapes()
+    for color, points in polygons or []:
+        fill = QColor(254, 254, 254) if boundry else QColor(*[int(c) for c in color])
+        pen = QPen(QColor(1, 1, 1) if boundry else fill)
+        pen.setCosmetic(True)
+        painter.setPen(pen)
+        painter.setBrush(fill)
+        painter.drawPolygon(QPolygonF([QtCore.QPointF(points[i], points[i+1]) \
+                                        for i in range(0, len(points) - 1, 2)]))
+    for color, points in lines or []:
+        pen = QPen(QColor(*[int(c) for c in color]))
+        pen.setCosmetic(True)
+        painter.setPen(pen)
+        painter.drawLine(QtCore.QLineF(points[0], points[1], points[2], points[3]))
+    painter.end()
+    return pixmap
+
+
+# runs draw_mode off the ui thread
+# emits each pipeline stage as it starts, then the output file name
+# cancel() stops the run at the next stage boundry
+# output is written into a temporary directory and only moved to its
+# name when the run was not cancelled, so a cancelled or superseded run
+# never writes the file a newer run writes
+class ConvertWorker(QtCore.QThread):
+
+    stage = QtCore.pyqtSignal(str)
+    converted = QtCore.pyqtSignal(str)
+    failed = QtCore.pyqtSignal(str)
+    # held while checking for cancel and moving output to its name
+    replacing = threading.Lock()
+
+    def __init__(self, image, mode, params, parent=None):
+        super(ConvertWorker, self).__init__(parent)
+        self.image = image
+        self.mode = mode
+        self.params = params
+        self.cancelled = False
+
+    # once cancel() returns, the output of this run is never moved in place
+    def cancel(self):
+        with self.replacing:
+            self.cancelled = True
+
+    def progress(self, stage):
+        if self.cancelled:
+            raise ConversionCancelled()
+        self.stage.emit(stage)
+
+    def run(self):
+        params = dict(self.params)
+        out_dir = params.pop("out_dir", None)
+        temp_dir = tempfile.mkdtemp(prefix=".convert-", dir=out_dir or ".")
+        try:
+            written = draw_mode(self.image, self.mode, progress=self.progress, \
+                                out_dir=temp_dir, **params)
+            converted = os.path.basename(written)
+            if out_dir:
+                converted = os.path.join(out_dir, converted)
+            with self.replacing:
+                if self.cancelled:
+                    return
+                os.replace(written, converted)
+        except ConversionCancelled:
+            return
+        except Exception as e:
+            self.failed.emit(repr(e))
+            return
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.converted.emit(converted)
+
+
 class MainWindow(QMainWindow):
 
     def __init__(self):
@@ -31,7 +124,21 @@ class MainWindow(QMainWindow):
         self.frame = 0
         self.boundry = 0
         self.grey_weighted = 0
-
+        # intermediate results reused when only later stages change
+        self.cache = StageCache()
+        self.worker = None
+        self.workers = set()
+        self.image_size = None
+        # live preview runs the pipeline on a downscaled copy of the image
+        self.live = 0
+        self.preview_image = None
+        self.preview_key = None
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(300)
+        self.preview_timer.timeout.connect(self.update_preview)
+        self.previewWidget = QLabel()
+        self.previewWidget.setWindowTitle("Preview")
         self.setWindowTitle("Flat Style SVG Generator")
         self.setGeometry(50, 50, 400, 500)
         self.home()
@@ -41,8 +148,12 @@ class MainWindow(QMainWindow):
     def file_open(self):
         name = QFileDialog.getOpenFileName(self, 'Open File')
         self.image = name[0]
-        self.pic.setPixmap(QPixmap(self.image))
+        pixmap = QPixmap(self.image)
+        self.image_size = (pixmap.width(), pixmap.height())
+        self.pic.setPixmap(pixmap)
         self.pic.show()
+        self.preview_image = None
+        self.schedule_preview()
         print(self.image)
 
     def set_mode(self, text):
@@ -61,6 +172,64 @@ class MainWindow(QMainWindow):
         else :
             self.boundry = 0
 
+    def set_live(self, state):
+        if state == QtCore.Qt.Checked:
+            self.live = 1
+            self.schedule_preview()
+        else :
+            self.live = 0
+            self.previewWidget.hide()
+
+    # restart debounce timer, preview updates once edits settle
+    def schedule_preview(self, *args):
+        if self.live:
+            self.preview_timer.start()
+
+    # downscaled copy of image for preview, loaded once per image
+    def load_preview_image(self):
+        im = cv2.imread(self.image)
+        if im is None:
+            return None
+        scale = min(1.0, PREVIEW_SIZE / max(im.shape[0], im.shape[1]))
+        if scale < 1.0:
+            im = cv2.resize(im, (max(1, int(im.shape[1]*scale)), \
+                                    max(1, int(im.shape[0]*scale))), \
+                            interpolation=cv2.INTER_AREA)
+        self.image_size = (self.image_size or (im.shape[1]/scale, im.shape[0]/scale))
+        self.preview_key = image_key(im)
+        return im
+
+    # run pipeline on downscaled image and paint result, no svg written
+    # grid size and skew are scaled along with the image,
+    # grid size kept at least PREVIEW_MIN_DIST so previews stay light
+    def update_preview(self):
+        if not self.live or not self.image or self.mode not in MODES:
+            return
+        try:
+            cull_pts = int(self.cull_pts_perct_edit.text())
+            cull_sbl = int(self.cull_sbl_perct_edit.text())
+            dist = int(self.dist_edit.text())
+            skew = int(self.skew_edit.text())
+        except ValueError:
+            return
+        if self.preview_image is None:
+            self.preview_image = self.load_preview_image()
+            if self.preview_image is None:
+                return
+        im = self.preview_image
+        scale = im.shape[1] / self.image_size[0]
+        polygons, lines = mode_shapes(im, self.mode, cull_pts=cull_pts, \
+                            cull_sbl=cull_sbl, \
+                            dist=max(PREVIEW_MIN_DIST, int(round(dist*scale))), \
+                            skew=int(round(skew*scale)), frame=self.frame, \
+                            grey_weighted=self.grey_weighted, \
+                            key=self.preview_key, cache=self.cache)
+        display = 600 / im.shape[0]
+        self.previewWidget.setPixmap(paint_shapes(im.shape[1], im.shape[0], \
+                                        polygons, lines, display, self.boundry))
+        self.previewWidget.resize(self.previewWidget.sizeHint())
+        self.previewWidget.show()
+
     def set_grey_weight(self, state):
         if state == QtCore.Qt.Checked:
             self.grey_weighted = 1
@@ -69,53 +238,64 @@ class MainWindow(QMainWindow):
 
     # action function for button convert when clicked
     # gathers all parameters on MainWindow
-    # call corresponding function to produce svg
+    # start conversion on worker thread, superseding any conversion in progress
     # if successfully prodeced svg, preview it
     def convert(self):
         self.cull_pts = int(self.cull_pts_perct_edit.text())
         self.cull_sbl = int(self.cull_sbl_perct_edit.text())
         self.dist = int(self.dist_edit.text())
         self.skew = int(self.skew_edit.text())
-        converted = None
         if self.image == None:
             print("No image Selected")
             return
-        if self.mode == "Delaunay":
-            converted = draw_dealunay(self.image, cull_pts_perct=self.cull_pts, \
-                            cull_sbl_perct=self.cull_sbl, frame=self.frame, \
-                            boundry=self.boundry, grey_weighted=self.grey_weighted)
-        elif self.mode == "Voronoi":
-            converted = draw_voronoi(self.image, cull_pts_perct=self.cull_pts, \
-                            cull_sbl_perct=self.cull_sbl, frame=self.frame, \
-                            boundry=self.boundry, grey_weighted=self.grey_weighted)
-        elif self.mode == "Tri-Grid":
-            converted = draw_grid(self.image, dist=self.dist, sides=3, \
-                                skew_dist=self.skew, boundry=self.boundry)
-        elif self.mode == "Square-Grid":
-            converted = draw_grid(self.image, dist=self.dist, sides=4, \
-                                skew_dist=self.skew, boundry=self.boundry)
-        elif self.mode == "Voronoi-Grid":
-            converted = draw_grid(self.image, dist=self.dist, sides=4, \
-                                skew_dist=self.skew, boundry=self.boundry, voronoi=1)
-        elif self.mode == "Ortho-Tree":
-            converted = draw_tree(self.image, dist=self.dist, skew_dist=self.skew, \
-                                cull_pts_perct=self.cull_pts, \
-                                cull_sbl_perct=self.cull_sbl, \
-                                random=0, grey_weighted=0)
-        elif self.mode == "Random-Tree":
-            converted = draw_tree(self.image, dist=self.dist, skew_dist=self.skew, \
-                                cull_pts_perct=self.cull_pts, \
-                                cull_sbl_perct=self.cull_sbl, \
-                                random=1, grey_weighted=self.grey_weighted)
-        else:
+        if self.mode not in MODES:
             print("Mode Error")
             return
-        if converted:
-            self.picy = 600
-            self.picx = self.picy * cv2.imread(self.image).shape[1]/cv2.imread(self.image).shape[0]
-            self.svgWidget = QtSvg.QSvgWidget(converted)
-            self.svgWidget.setGeometry(450,50,self.picx,self.picy)
-            self.svgWidget.show()
+        self.cancel()
+        params = dict(cull_pts=self.cull_pts, cull_sbl=self.cull_sbl, \
+                        dist=self.dist, skew=self.skew, frame=self.frame, \
+                        boundry=self.boundry, grey_weighted=self.grey_weighted, \
+                        cache=self.cache)
+        worker = ConvertWorker(self.image, self.mode, params, self)
+        worker.stage.connect(self.show_stage)
+        worker.converted.connect(self.show_converted)
+        worker.failed.connect(self.show_failed)
+        worker.finished.connect(lambda: self.workers.discard(worker))
+        self.workers.add(worker)
+        self.worker = worker
+        self.status.setText("Converting...")
+        worker.start()
+
+    # cancel conversion in progress, it stops at its next stage
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+            self.status.setText("Cancelled")
+
+    def show_stage(self, stage):
+        if self.sender() is self.worker:
+            self.status.setText("Converting: " + stage)
+
+    def show_failed(self, error):
+        if self.sender() is self.worker:
+            self.worker = None
+            self.status.setText("Failed: " + error)
+
+    # preview converted svg, sized by aspect ratio of the loaded image
+    def show_converted(self, converted):
+        if self.sender() is not self.worker:
+            return
+        self.worker = None
+        self.status.setText("Converted: " + converted)
+        if self.image_size is None:
+            size = QImageReader(self.image).size()
+            self.image_size = (size.width(), size.height())
+        self.picy = 600
+        self.picx = int(self.picy * self.image_size[0]/max(self.image_size[1], 1))
+        self.svgWidget = QtSvg.QSvgWidget(converted)
+        self.svgWidget.setGeometry(450,50,self.picx,self.picy)
+        self.svgWidget.show()
 
     # all widgets on MainWindow
     def home(self):
@@ -129,6 +309,15 @@ class MainWindow(QMainWindow):
         btnc.resize(btnc.sizeHint())
         btnc.move(200, 410)
 
+        btnx = QPushButton('Cancel', self)
+        btnx.clicked.connect(self.cancel)
+        btnx.resize(btnx.sizeHint())
+        btnx.move(300, 410)
+
+        self.status = QLabel("", self)
+        self.status.move(50, 470)
+        self.status.resize(330, 25)
+
         cull_pts_perct_label = QLabel("Density", self)
         cull_pts_perct_label.move(50, 90)
         self.cull_pts_perct_edit = QLineEdit("2", self)
@@ -172,13 +361,8 @@ class MainWindow(QMainWindow):
         mode_lb.move(50, 25)
         mode_lb.resize(mode_lb.sizeHint())
         mode_box = QComboBox(self)
-        mode_box.addItem("Delaunay")
-        mode_box.addItem("Voronoi")
-        mode_box.addItem("Tri-Grid")
-        mode_box.addItem("Square-Grid")
-        mode_box.addItem("Voronoi-Grid")
-        mode_box.addItem("Ortho-Tree")
-        mode_box.addItem("Random-Tree")
+        for mode in MODES:
+            mode_box.addItem(mode)
         mode_box.move(150, 20)
         mode_box.resize(mode_box.sizeHint())
         mode_box.activated[str].connect(self.set_mode)
@@ -193,6 +377,18 @@ class MainWindow(QMainWindow):
         self.pic.setScaledContents(True)
         self.pic.show()
 
+        live_preview = QCheckBox("Live Preview", self)
+        live_preview.resize(live_preview.sizeHint())
+        live_preview.move(50, 440)
+        live_preview.stateChanged.connect(self.set_live)
+
+        for edit in (self.cull_pts_perct_edit, self.cull_sbl_perct_edit, \
+                        self.dist_edit, self.skew_edit):
+            edit.textChanged.connect(self.schedule_preview)
+        for box in (pin_frame, edge_only, grey_weighted):
+            box.stateChanged.connect(self.schedule_preview)
+        mode_box.activated[str].connect(self.schedule_preview)
+
         author_lb = QLabel("Peiyi Hou, 2018", self)
         author_lb.move(275, 450)
         pic_label.resize(400, 25)
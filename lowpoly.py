@@ -1,12 +1,19 @@
 from pprint import pprint
-import math
+import os
 import cv2
-import argparse
 import numpy as np
-import random
-import sys
-import queue
 from svg import *
+from raster import write_raster
+from cache import content_hash
+from tracing import traced, result_length, argument_length, file_size
+from triangulation import triangulate, image_sites, site_subdiv
+from polygons import PolygonSet, polygons_from_rows, polygons_from_list
+from poisson import poisson_points
+from merge import join_pairs
+# core and refine import this module back as a whole, and are used at
+# call time only
+import core
+import refine
 
 '''
 Author: Peiyi Hou
@@ -14,129 +21,156 @@ This file contains all geometry generating and processing functions
 '''
 
 # build saliency map serve as edge feature reference
-# return nested list with grayscale value of each pixel
+# return 2d uint8 array with gradient value of each pixel
+# gradients are saturated at 255 instead of wrapping around
+@traced("sobel")
 def sobel(image):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     sobelx = cv2.Sobel(gray, cv2.CV_64F, 1, 0)
     sobely = cv2.Sobel(gray, cv2.CV_64F, 0, 1)
 
-    sobelx = np.uint8(np.absolute(sobelx))
-    sobely = np.uint8(np.absolute(sobely))
+    sobelx = cv2.convertScaleAbs(sobelx)
+    sobely = cv2.convertScaleAbs(sobely)
     sobelcombine = cv2.bitwise_or(sobelx,sobely)
 
-    return sobelcombine.tolist()
+    return sobelcombine
 
 # extract featured points from saliency map given passed in Threshould
-# return a list of points in tuple (x,y)
+# points are distinct and sorted by (x,y), as np.unique would sort them
+# return (N, 2) int32 array of points (x,y)
+@traced("cull_sobel", result_length("points"))
 def cull_sobel(image, cull_perct):
-    new_list = []
-    for i in range(len(image)):
-        for j in range(len(image[0])):
-            if (image[i][j] >= cull_perct):
-                new_list.append((j,i))
-    return new_list
+    xs, ys = np.nonzero(np.asarray(image).T >= cull_perct)
+    return np.column_stack((xs, ys)).astype(np.int32)
 
 # Further reduce points count given specified cull percentage
-# return a list of points in tuple (x,y)
-def cull_points(points, cull_perct):
-    new_list = []
+# points are sampled without replacement, optionally weighted
+# points are distinct, e.g. of cull_sobel, so they are not deduplicated
+# return (N, 2) int32 array of points (x,y)
+@traced("cull_points", result_length("points"))
+def cull_points(points, cull_perct, weights=None, seed=None):
     cull_num = int(len(points) * cull_perct/100)
-    for i in range(cull_num):
-        new_list.append(random.choice(points))
-    return new_list
+    return sample_points(points, cull_num, weights=weights, seed=seed, unique=1)
+
+
+# draw count unique points from point set with a seeded numpy Generator
+# weights, if given, bias the draw (e.g. gradient magnitude of each point)
+# only points with positive weight can be drawn
+# unique skips deduplication of points already distinct and sorted by (x,y)
+# return (N, 2) int32 array of points (x,y)
+def sample_points(points, count, weights=None, seed=None, unique=0):
+    rng = np.random.default_rng(seed)
+    points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+    index = slice(None)
+    if not unique:
+        points, index = np.unique(points, axis=0, return_index=True)
+    p = None
+    if weights is not None:
+        p = np.asarray(weights, dtype=np.float64)[index]
+        count = min(count, np.count_nonzero(p))
+        if count > 0:
+            p = p / p.sum()
+    count = min(count, len(points))
+    if count <= 0:
+        return np.empty((0, 2), dtype=np.int32)
+    chosen = rng.choice(len(points), size=count, replace=False, p=p)
+    return points[np.sort(chosen)]
 
 
 # wrapper function for cull_sobel and cull_points
-def extract_points(image, cull_sobel_prect=0, cull_points_perct=100):
-    saliency = sobel(image)
+# weighted favours points with stronger gradient
+# precomputed saliency map of image can be passed in
+@traced("extract_points", result_length("points"))
+def extract_points(image, cull_sobel_prect=0, cull_points_perct=100, \
+                    weighted=0, seed=None, saliency=None):
+    if saliency is None:
+        saliency = sobel(image)
     culled_saliency = cull_sobel(saliency, cull_sobel_prect)
-    return cull_points(culled_saliency, cull_points_perct)
+    weights = None
+    if weighted:
+        weights = saliency[culled_saliency[:,1], culled_saliency[:,0]]
+    return cull_points(culled_saliency, cull_points_perct, weights=weights, \
+                        seed=seed)
 
 
 # add pin points on boundry of rectangular area
-def add_frame_points(points, image, cull_perct):
+# return (N, 2) int32 array of points with pin points appended
+@traced("add_frame_points", result_length("points"))
+def add_frame_points(points, image, cull_perct, seed=None):
+    rng = np.random.default_rng(seed)
     x = image.shape[1]
     y = image.shape[0]
-    for i in range(len(points) * cull_perct // 400):
-        xpos = random.randrange(x)
-        points.append((xpos, 0))
-        points.append((xpos, y-1))
-    for i in range(len(points) * cull_perct // 400):
-        ypos = random.randrange(y)
-        points.append((0, ypos))
-        points.append((x-1, ypos))
-    points.append((0,y-1))
-    points.append((x-1,y-1))
-    points.append((x-1,0))
-    points.append((0,0))
+    points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+    count = len(points) * cull_perct // 400
+    xpos = rng.integers(x, size=count)
+    ypos = rng.integers(y, size=count)
+    frame = [np.column_stack((xpos, np.zeros_like(xpos))),
+             np.column_stack((xpos, np.full_like(xpos, y-1))),
+             np.column_stack((np.zeros_like(ypos), ypos)),
+             np.column_stack((np.full_like(ypos, x-1), ypos)),
+             [(0,y-1), (x-1,y-1), (x-1,0), (0,0)]]
+    return np.concatenate([points] + [np.asarray(f, dtype=np.int32) for f in frame])
 
 # produce regular 2d grid
-# return nested list of points [[[x,y],[x,y]],
-#                               [[x,y],[x,y]]]
-# skew every other row of points if specified
+# return (rows, cols, 2) int array of points, grid[i][j] is [x,y]
+# skew every other row of points if specified, points skewed out of
+# image are dropped and the other rows trimmed to the same length
+@traced("produce_grid")
 def produce_grid(image, dist, skew_dist=None):
     x = image.shape[1]
     y = image.shape[0]
-    pts = []
-    for i in range(0,y,dist):
-        row = []
-        for j in range(0,x,dist):
-            pt = [j,i]
-            row.append(pt)
-        pts.append(row)
-
-    if skew_dist:
-        #skew_angle = skew_angle % 45
+    xs = np.arange(0, x, dist)
+    ys = np.arange(0, y, dist)
+    if skew_dist and len(ys) > 1:
         skew_dist = min(skew_dist, x)
-        for i in range(1,len(pts),2):
-            for pt in pts[i]:
-                pt[0] += skew_dist
-                if pt[0] >= x:
-                    #print("removed")
-                    pts[i].remove(pts[i][-1])
-                    pts[i-1].remove(pts[i-1][-1])
-    return pts
+        xs = xs[xs + skew_dist < x]
+    grid = np.empty((len(ys), len(xs), 2), dtype=np.int64)
+    grid[:,:,0] = xs
+    grid[:,:,1] = ys[:,np.newaxis]
+    if skew_dist:
+        grid[1::2,:,0] += skew_dist
+    return grid
+
+
+# vertex indices of cells of a rows x cols grid, flattened row by row
+# quadlaterals run pt1 pt2 pt4 pt3, triangles alternate diagonal per row
+# return (F, sides) int array
+def grid_faces(rows, cols, sides=3):
+    index = np.arange(rows * cols).reshape(rows, cols)
+    pt1 = index[:-1,:-1]
+    pt2 = index[:-1,1:]
+    pt3 = index[1:,:-1]
+    pt4 = index[1:,1:]
+    if sides == 4:
+        return np.stack((pt1, pt2, pt4, pt3), axis=-1).reshape(-1, 4)
+    if sides != 3:
+        return np.empty((0, sides), dtype=np.intp)
+    even = (np.arange(rows - 1) % 2 == 0)[:,np.newaxis,np.newaxis]
+    triangle_1 = np.where(even, np.stack((pt1, pt2, pt3), axis=-1), \
+                                np.stack((pt1, pt3, pt4), axis=-1))
+    triangle_2 = np.where(even, np.stack((pt2, pt3, pt4), axis=-1), \
+                                np.stack((pt1, pt2, pt4), axis=-1))
+    return np.stack((triangle_1, triangle_2), axis=2).reshape(-1, 3)
 
 
 # produce triangle or quadlateral shape as specified from 2d grid
-# return polygon represented by list of flattened points [x,y,x,y,x,y]
+# return PolygonSet of triangles or quadlaterals
+@traced("polygons_from_grid", result_length("polygons"))
 def polygons_from_grid(grid, sides=3):
-
-    polygons = []
-    for i in range(len(grid) - 1):
-        for j in range(len(grid[i]) - 1):
-            pt1 = grid[i][j]
-            pt2 = grid[i][j+1]
-            pt3 = grid[i+1][j]
-            pt4 = grid[i+1][j+1]
-            if sides == 3:
-                if i%2==0:
-                    triangle_1 = [pt1[0],pt1[1],pt2[0],pt2[1],pt3[0],pt3[1]]
-                    triangle_2 = [pt2[0],pt2[1],pt3[0],pt3[1],pt4[0],pt4[1]]
-                    polygons.append(triangle_1)
-                    polygons.append(triangle_2)
-                if i%2==1:
-                    triangle_1 = [pt1[0],pt1[1],pt3[0],pt3[1],pt4[0],pt4[1]]
-                    triangle_2 = [pt1[0],pt1[1],pt2[0],pt2[1],pt4[0],pt4[1]]
-                    polygons.append(triangle_1)
-                    polygons.append(triangle_2)
-            if sides == 4:
-                rect = [pt1[0],pt1[1],pt2[0],pt2[1],pt4[0],pt4[1],pt3[0],pt3[1]]
-                polygons.append(rect)
-    return polygons
+    grid = np.asarray(grid)
+    if grid.ndim != 3:
+        return polygons_from_rows(np.empty((0, 2 * sides)))
+    faces = grid_faces(grid.shape[0], grid.shape[1], sides)
+    return polygons_from_rows(grid.reshape(-1, 2)[faces].reshape(len(faces), 2 * sides))
 
 
 # build opencv subdivison within image sized rectangluar area
+# points inside image are inserted at once, deduplicated and sorted
 # insert points into subdiv and return
+@traced("build_subdiv", argument_length(1, "points"))
 def build_subdiv(image, points):
-    #print(points)
-    rect = (0,0, image.shape[1], image.shape[0])
-    subdiv = cv2.Subdiv2D(rect)
-    for point in points:
-        if rect_contains(rect, point):
-            #print(point)
-            subdiv.insert(point)
-    return subdiv
+    sites, _ = image_sites(points, image.shape[1], image.shape[0])
+    return site_subdiv(sites, image.shape[1], image.shape[0])
 
 # check if point in rectangular area
 def rect_contains(rect, point) :
@@ -152,189 +186,136 @@ def rect_contains(rect, point) :
 
 
 # get openCV delaunay_triangulation from subdiv
-# return triangle represented by list [x,y,x,y,x,y]
+# return PolygonSet of triangles inside image
+@traced("delaunay_triangulation", result_length("polygons"))
 def delaunay_triangulation(img, subdiv) :
-    triangleList = subdiv.getTriangleList()
-    size = img.shape
-    r = (0, 0, size[1], size[0])
-    valid_triangles = []
-    for t in triangleList :
-        pt1 = (t[0], t[1])
-        pt2 = (t[2], t[3])
-        pt3 = (t[4], t[5])
-        if rect_contains(r, pt1) \
-            and rect_contains(r, pt2) \
-            and rect_contains(r, pt3) :
-            valid_triangles.append(t)
-    return valid_triangles
+    triangles = np.asarray(subdiv.getTriangleList(), np.float32).reshape(-1, 6)
+    xs = triangles[:,0::2]
+    ys = triangles[:,1::2]
+    valid = ((xs >= 0) & (xs <= img.shape[1]) \
+            & (ys >= 0) & (ys <= img.shape[0])).all(axis=1)
+    return polygons_from_rows(triangles[valid])
 
 
 # get openCV voronoi facets from subdiv
-# return facets represented by list [x,y,x,y,x,y...]
+# return PolygonSet of facets clamped to image
+@traced("make_voronoi", result_length("polygons"))
 def make_voronoi(img, subdiv):
-    x = img.shape[1]
-    y = img.shape[0]
     (facets, centers) = subdiv.getVoronoiFacetList([])
-    new_list = []
-    for i in range(len(facets)):
-        points = []
-        for pt in facets[i]:
-            pt_x = pt[0]
-            pt_y = pt[1]
-            if pt_x < 0:
-                pt_x = 0
-            if pt_y < 0:
-                pt_y = 0
-            if pt_x >= x:
-                pt_x = x-1
-            if pt_y >= y:
-                pt_y = y-1
-            points.append(pt_x)
-            points.append(pt_y)
-        new_list.append(points)
-    return new_list
+    return clamp_facets(img, facets)
+
+
+# clamp facet vertices into image
+# facets is a PolygonSet or a list of facets
+# return PolygonSet
+def clamp_facets(img, facets):
+    if not isinstance(facets, PolygonSet):
+        facets = polygons_from_list(facets)
+    return facets.clipped(img.shape[1], img.shape[0])
+
+
+# delaunay triangles of points inside image
+# return PolygonSet of triangles
+def delaunay_polygons(img, points):
+    tri = triangulate(points, img.shape[1], img.shape[0])
+    return polygons_from_rows(tri.points[tri.triangles].reshape(-1, 6))
+
+
+# voronoi facets of points inside image, clamped to image
+# return PolygonSet of facets
+def voronoi_polygons(img, points):
+    tri = triangulate(points, img.shape[1], img.shape[0], facets=1)
+    facets = PolygonSet(tri.vertices[tri.facets], tri.offsets)
+    return clamp_facets(img, facets)
 
 
 # produce a set of points based on the greyscale value of passed in Image
 # darker area has keeps more points,lighter area keeps less points
-# return a list of points in tuple [(x,y), ...]
-def greyscale_points(image, cull_perct=85):
+# grid points are binned by grey value once and culled per bin
+# grid size dist defaults to 1% of shorter image side
+# return (N, 2) int32 array of points (x,y)
+@traced("greyscale_points", result_length("points"))
+def greyscale_points(image, cull_perct=85, seed=None, dist=None):
+    rng = np.random.default_rng(seed)
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    dist = int(min(image.shape[0], image.shape[1])/100)
-    points = produce_grid(image, dist)
-    new_list = []
-    for i in range(5,256,5):
-        low = i-5
-        high = i
-        interval = []
-        for n in range(len(points)):
-            for m in range(len(points[n])):
-                x = points[n][m][0]
-                y = points[n][m][1]
-                if gray[y][x] < high and gray[y][x] >= low:
-                    fuzzy = list(range(int(-dist/2), int(dist/2)))
-                    if (len(fuzzy) == 0):
-                        fuzzy = [0]
-                    fuzzy_x = x + random.choice(fuzzy)
-                    fuzzy_y = y + random.choice(fuzzy)
-                    if fuzzy_x < 0:
-                        fuzzy_x = 0
-                    if fuzzy_y < 0:
-                        fuzzy_y = 0
-                    if fuzzy_x >= image.shape[1]:
-                        fuzzy_x = image.shape[1]-1
-                    if fuzzy_y >= image.shape[0]:
-                        fuzzy_y = image.shape[0]-1
-                    interval.append((fuzzy_x,fuzzy_y))
-
-        # use tanh as sigmoid function to control cull ratio
-        # for each greyscale interval
-        a = low * 6/255 - 3
-        ratio = 1 - (math.tanh(a) + 1)/2
-        count = int(cull_perct/100*len(interval))
-        culled_count = int(count*ratio)
-        for j in range(culled_count):
-            new_list.append(random.choice(interval))
-    return new_list
+    if dist is None:
+        dist = max(1, int(min(image.shape[0], image.shape[1])/100))
+    ys, xs = np.mgrid[0:image.shape[0]:dist, 0:image.shape[1]:dist]
+    xs = xs.ravel()
+    ys = ys.ravel()
+
+    # greyscale intervals [low, low+5), pure white falls in no interval
+    lows = np.arange(0, 256, 5)
+    bins = np.digitize(gray[ys, xs], lows) - 1
+
+    # use tanh as sigmoid function to control cull ratio
+    # for each greyscale interval
+    ratio = 1 - (np.tanh(lows * 6/255 - 3) + 1)/2
+    ratio[-1] = 0
+    count = (cull_perct/100 * np.bincount(bins, minlength=len(lows))).astype(int)
+    culled_count = (count * ratio).astype(int)
+
+    # keep the first culled_count points of each interval in random order
+    order = np.lexsort((rng.random(len(bins)), bins))
+    sorted_bins = bins[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_bins, sorted_bins)
+    keep = order[rank < culled_count[sorted_bins]]
+
+    # jitter kept points within half grid size
+    low = int(-dist/2)
+    high = int(dist/2)
+    fuzzy = np.zeros((len(keep), 2), dtype=np.int64)
+    if high > low:
+        fuzzy = rng.integers(low, high, size=(len(keep), 2))
+    fuzzy_x = np.clip(xs[keep] + fuzzy[:,0], 0, image.shape[1]-1)
+    fuzzy_y = np.clip(ys[keep] + fuzzy[:,1], 0, image.shape[0]-1)
+    return np.column_stack((fuzzy_x, fuzzy_y)).astype(np.int32)
+
+
+# get unique edges of delaunay triangulation of point set
+# edges to subdiv's virtual outer vertices are dropped
+# return (points, edges), unique (N, 2) int32 points inside image
+# sorted by (x, y) and (E, 2) int index array into points, one row per edge
+@traced("delaunay_edges")
+def delaunay_edges(image, points):
+    points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+    tri = triangulate(points, image.shape[1], image.shape[0])
+    return tri.points.astype(np.int32), tri.edges
+
+
+# kruskal's algorithm over weighted edge array
+# union-find is join_pairs of merge
+# return index array of edges in minimum spanning tree (forest if disconnected)
+@traced("kruskal", result_length("lines"))
+def kruskal(count, edges, weights):
+    parent = list(range(count))
+    tree = []
+    order = np.argsort(weights, kind="stable")
+    for i in join_pairs(parent, edges[order].tolist()):
+        tree.append(i)
+        if len(tree) == count - 1:
+            break
+    return order[np.array(tree, dtype=np.intp)]
 
 
 # produce a mst of points passed in as graph
 # whose weight is the euclidean dist between points
-# return a list of lines as [[s_x, s_y, e_x, e_y], ...]
+# do not connect every point with other points
+# instead perform triangulation and keep sides of triangles as edges of graph
+# return (M, 4) int array of lines as [[s_x, s_y, e_x, e_y], ...]
+@traced("euclidean_mst", result_length("lines"))
 def euclidean_mst(points, image):
-    class Edge:
-        def __init__(self, pt1, pt2, weight):
-            self.u = pt1
-            self.v = pt2
-            self.w = weight
-        def __eq__(self, other):
-            return (self.w == other.w) and \
-                    ((self.u == other.u and self.v == other.v) or\
-                     (self.u == other.v and self.v == other.u))
-        def __lt__(self, other):
-            return self.w < other.w
-        def __hash__(self):
-            return hash(self.u[0]+self.u[1]+self.v[0]+self.v[1]+round(self.w,2))
-        def __str__(self):
-            return str(self.u)+str(self.v)+str(round(self.w,2))
-        def __repr__(self):
-            return str(self)
-
-    # build graph from point set
-    # do not connect every point with other points
-    # instead perform triangulation and keep sides of triangles as edges of graph
-    # returns adjList {pt:{edge, ...}, ...}
-    def build_graph(points):
-        adjLilst = {}
-        for pt in points:
-            adjLilst[pt] = set()
-        subdiv = build_subdiv(image, points)
-        triangleList = subdiv.getTriangleList()
-        size = image.shape
-        r = (0, 0, size[1], size[0])
-        for t in triangleList :
-            pt1 = (int(t[0]), int(t[1]))
-            pt2 = (int(t[2]), int(t[3]))
-            pt3 = (int(t[4]), int(t[5]))
-            if rect_contains(r, pt1) and rect_contains(r, pt2) and rect_contains(r, pt3):
-                dist_12 = math.sqrt((pt1[0]-pt2[0])*(pt1[0]-pt2[0])\
-                                        +(pt1[1]-pt2[1])*(pt1[1]-pt2[1]))
-                dist_13 = math.sqrt((pt1[0]-pt3[0])*(pt1[0]-pt3[0])\
-                                        +(pt1[1]-pt3[1])*(pt1[1]-pt3[1]))
-                dist_23 = math.sqrt((pt2[0]-pt3[0])*(pt2[0]-pt3[0])\
-                                        +(pt2[1]-pt3[1])*(pt2[1]-pt3[1]))
-                edge_12 = Edge(pt1, pt2, dist_12)
-                edge_13 = Edge(pt1, pt3, dist_13)
-                edge_23 = Edge(pt2, pt3, dist_23)
-                adjLilst[pt1].add(edge_12)
-                adjLilst[pt1].add(edge_13)
-                adjLilst[pt2].add(edge_23)
-        return adjLilst
-
-    # prim's algorithm for mst
-    # return a set of Edges
-    def prims(start, adj):
-        mst = set()
-        pq = queue.PriorityQueue()
-        visited = {start}
-        visited_edge = set()
-        for e in adj[start]:
-            pq.put(e)
-            visited_edge.add(e)
-        while(len(visited) < len(adj)):
-            if pq.qsize() <= 0:
-                print("terminated early")
-                # ternimated early, it is a bug happens time to time
-                # with large point set that I have not fixed yet
-                return mst
-            min_edge = pq.get()
-            curr_pt = min_edge.v
-            if (min_edge.v not in visited):
-                mst.add(min_edge)
-                visited.add(min_edge.v)
-            elif (min_edge.u not in visited):
-                mst.add(min_edge)
-                visited.add(min_edge.u)
-                curr_pt = min_edge.u
-            for edge in adj[curr_pt]:
-                if (edge not in visited_edge):
-                    if (edge.v not in visited) or (edge.u not in visited):
-                        visited_edge.add(edge)
-                        pq.put(edge)
-        return mst
-    # convert Edge to lines in [s_x, s_y, e_x, e_y]
-    tree = prims(points[0], build_graph(points))
-    lines = []
-    for edge in tree:
-        line = [edge.u[0], edge.u[1], edge.v[0], edge.v[1]]
-        lines.append(line)
-    return lines
+    points, edges = delaunay_edges(image, points)
+    diff = points[edges[:,0]] - points[edges[:,1]]
+    weights = np.hypot(diff[:,0], diff[:,1])
+    tree = edges[kruskal(len(points), edges, weights)]
+    return np.concatenate((points[tree[:,0]], points[tree[:,1]]), axis=1)
 
 
 # calculate area center point
 # then find color base on center point
 # return a tuple of rgb(r,g,b)
-def polygon_color(image,points,mask=None):
+def polygon_color(image,points,mask=None,integral=None):
 
     sum_x = 0
     for i in range(0, len(points), 2):
@@ -344,183 +325,620 @@ def polygon_color(image,points,mask=None):
         sum_y += points[i]
     avg_x = sum_x/(len(points)/2)
     avg_y = sum_y/(len(points)/2)
-    return average_color_from_mask(image, (avg_x, avg_y), mask)
+    return average_color_from_mask(image, (avg_x, avg_y), mask, integral)
+
+
+# build integral image of squared bgr values for rectangular mask lookups
+# build once per image and pass to every average_color_from_mask call
+# return float64 array of shape (height+1, width+1, 3)
+def color_integral(image):
+    _, sqsum = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    return sqsum
 
 
 # helper function for polygon_color
-# build rectangular mask and calculate mean rgb of the mask area
+# use rectangular mask and calculate root mean square rgb of the mask area
+# mask is clamped to image boundry, lookup is O(1) with integral image
 # return rgb(r,g,b)
 # or use center point color without mask
-def average_color_from_mask(image, center, mask=None):
-
-    avg_x = int(center[1]) - 1
-    avg_y = int(center[0]) - 1
-    avg_r = image[avg_x][avg_y][2]
-    avg_g = image[avg_x][avg_y][1]
-    avg_b = image[avg_x][avg_y][0]
+def average_color_from_mask(image, center, mask=None, integral=None):
+
+    height = image.shape[0]
+    width = image.shape[1]
+    row = min(max(int(center[1]) - 1, 0), height - 1)
+    col = min(max(int(center[0]) - 1, 0), width - 1)
+    avg_r = image[row][col][2]
+    avg_g = image[row][col][1]
+    avg_b = image[row][col][0]
     if mask:
-        clr_r = 0
-        clr_g = 0
-        clr_b = 0
-        pixel_count = 0
+        if integral is None:
+            integral = color_integral(image)
         half_mask_x = int(mask[0]//2)
         half_mask_y = int(mask[1]//2)
-        for i in range(avg_x - half_mask_x, avg_x + half_mask_x):
-            if i < 0:
-                i = 0
-            if i > image.shape[0]:
-                i = image.shape[0]
-            for j in range(avg_y - half_mask_y, avg_y + half_mask_y):
-                if j < 0:
-                    j = 0
-                if j > image.shape[1]:
-                    j = image.shape[1]
-                rgb = image[i][j]
-                clr_r += int(rgb[0])*int(rgb[0])
-                clr_g += int(rgb[1])*int(rgb[1])
-                clr_b += int(rgb[2])*int(rgb[2])
-                pixel_count += 1
-        avg_r = int(math.sqrt(clr_r/pixel_count))
-        avg_g = int(math.sqrt(clr_g/pixel_count))
-        avg_b = int(math.sqrt(clr_b/pixel_count))
+        top = min(max(row - half_mask_y, 0), height)
+        bottom = min(max(row + half_mask_y, 0), height)
+        left = min(max(col - half_mask_x, 0), width)
+        right = min(max(col + half_mask_x, 0), width)
+        pixel_count = (bottom - top) * (right - left)
+        if pixel_count > 0:
+            sq_sum = integral[bottom][right] - integral[top][right] \
+                    - integral[bottom][left] + integral[top][left]
+            avg_b, avg_g, avg_r = \
+                np.sqrt(np.maximum(sq_sum, 0)/pixel_count).astype(int).tolist()
     return [avg_r, avg_g, avg_b]
 
 
 # get bounding rectangle of certain polygon served as mask used for above
 # return tupe(x_size, y_size)
 def bounding_size(polygon):
-    min_x = sys.maxsize
-    min_y = sys.maxsize
-    max_x = sys.maxsize* -1
-    max_y = sys.maxsize* -1
-
-    for i in range(0, len(polygon), 2):
-        if polygon[i] > max_x:
-            max_x = polygon[i]
-        if polygon[i] < min_x:
-            min_x = polygon[i]
-    for i in range(1, len(polygon), 2):
-        if polygon[i] > max_y:
-            max_y = polygon[i]
-        if polygon[i] < min_y:
-            min_y = polygon[i]
-
-    size_x = abs(max_x - min_x)
-    size_y = abs(max_y - min_y)
+    points = np.asarray(polygon).reshape(-1, 2)
+    size_x, size_y = points.max(axis=0) - points.min(axis=0)
     return (size_x,size_y)
 
 
+# rasterize all polygons into one int32 label map
+# pixels covered by polygon i are labeled i+1, uncovered pixels are 0
+# later polygons overwrite earlier ones where they overlap
+def polygon_label_map(image, polygons):
+    labels = np.zeros(image.shape[:2], dtype=np.int32)
+    # 4 fractional bits keep sub-pixel vertex positions
+    if isinstance(polygons, PolygonSet):
+        pts = np.round(polygons.coords.astype(np.float64) * 16).astype(np.int32)
+        offsets = polygons.offsets
+        for i in range(len(polygons)):
+            cv2.fillPoly(labels, [pts[offsets[i]:offsets[i+1]]], i+1, shift=4)
+        return labels
+    if len(polygons) and len(set(len(polygon) for polygon in polygons)) == 1:
+        # same vertex count, convert all polygons in one go
+        pts = np.round(np.asarray(polygons, dtype=np.float64) * 16)
+        pts = pts.astype(np.int32).reshape(len(polygons), -1, 2)
+    else:
+        pts = [np.round(np.asarray(polygon, dtype=np.float64).reshape(-1, 2) \
+                * 16).astype(np.int32) for polygon in polygons]
+    for i in range(len(pts)):
+        cv2.fillPoly(labels, [pts[i]], i+1, shift=4)
+    return labels
+
+
+# average color of every polygon over all pixels it covers
+# rms uses root mean square of channel values like average_color_from_mask
+# polygons covering no pixel fall back to polygon_color
+# return (N, 3) int array of rgb
+@traced("mean_polygon_colors", argument_length(1, "polygons"))
+def mean_polygon_colors(image, polygons, rms=False):
+    labels = polygon_label_map(image, polygons).ravel()
+    length = len(polygons) + 1
+    counts = np.bincount(labels, minlength=length)[1:]
+    colors = np.empty((len(polygons), 3), dtype=np.float64)
+    for i in range(3):
+        channel = image[:,:,2-i].ravel().astype(np.float64)
+        if rms:
+            channel *= channel
+        colors[:,i] = np.bincount(labels, weights=channel, minlength=length)[1:]
+    colors /= np.maximum(counts, 1)[:,np.newaxis]
+    if rms:
+        colors = np.sqrt(colors)
+    colors = colors.astype(int)
+    empty = np.flatnonzero(counts == 0)
+    if isinstance(polygons, PolygonSet):
+        if len(empty):
+            colors[empty] = center_colors(image, polygons.take(empty))
+        return colors
+    for i in empty:
+        colors[i] = polygon_color(image, polygons[i])
+    return colors
+
+
+# pixel under center of every polygon, as in average_color_from_mask
+# return (rows, cols) int arrays
+def center_pixels(image, polygons):
+    if isinstance(polygons, PolygonSet):
+        centers = polygons.centers()
+    else:
+        polygons = np.asarray(polygons, dtype=np.float64)
+        centers = np.column_stack((polygons[:,0::2].mean(axis=1), \
+                                    polygons[:,1::2].mean(axis=1)))
+    rows = (centers[:,1].astype(int) - 1).clip(0, image.shape[0] - 1)
+    cols = (centers[:,0].astype(int) - 1).clip(0, image.shape[1] - 1)
+    return rows, cols
+
+
+# color of pixel under center of every polygon, same as polygon_color
+# polygons is a PolygonSet or a 2d array with one polygon [x,y,x,y...] per row
+# return (N, 3) int array of rgb
+def center_colors(image, polygons):
+    rows, cols = center_pixels(image, polygons)
+    return image[rows, cols][:,::-1]
+
+
+# root mean square color over bounding box of every polygon of a
+# PolygonSet, same as polygon_color with bounding_size mask
+# return (N, 3) int array of rgb
+def box_colors(image, polygons, integral=None):
+    if integral is None:
+        integral = color_integral(image)
+    height, width = image.shape[:2]
+    rows, cols = center_pixels(image, polygons)
+    mins, maxs = polygons.bounds()
+    half = ((maxs.astype(np.float64) - mins) // 2).astype(int)
+    top = (rows - half[:,1]).clip(0, height)
+    bottom = (rows + half[:,1]).clip(0, height)
+    left = (cols - half[:,0]).clip(0, width)
+    right = (cols + half[:,0]).clip(0, width)
+    pixel_count = (bottom - top) * (right - left)
+    sq_sum = integral[bottom, right] - integral[top, right] \
+                - integral[bottom, left] + integral[top, left]
+    box = np.sqrt(np.maximum(sq_sum, 0) / np.maximum(pixel_count, 1)[:,np.newaxis])
+    colors = image[rows, cols][:,::-1].astype(int)
+    return np.where(pixel_count[:,np.newaxis] > 0, box.astype(int)[:,::-1], colors)
+
+
 # associate_polygon_with_color wraps polygon and its average color
-# return a list of tuple (color, points)
+# color_mode "center" samples the pixel under polygon center
+# "box" takes root mean square over polygon bounding box
+# "mean" and "rms" average over the whole polygon area
+# return the PolygonSet with colors for a PolygonSet,
+# otherwise a list of tuple (color, points)
 # svg will read the tuple for svg output
 # should be called before any svg functions
-def associate_polygon_with_color(image, polygons):
+@traced("associate_polygon_with_color", argument_length(1, "polygons"))
+def associate_polygon_with_color(image, polygons, color_mode="center"):
+    if isinstance(polygons, PolygonSet):
+        if color_mode in ("mean", "rms"):
+            colors = mean_polygon_colors(image, polygons, rms=color_mode == "rms")
+        elif color_mode == "box":
+            colors = box_colors(image, polygons)
+        else:
+            colors = center_colors(image, polygons)
+        return polygons.with_colors(colors)
+    if color_mode in ("mean", "rms"):
+        colors = mean_polygon_colors(image, polygons, rms=color_mode == "rms")
+        return list(zip(colors.tolist(), polygons))
+    if color_mode == "center" and isinstance(polygons, np.ndarray) \
+            and polygons.ndim == 2:
+        return list(zip(center_colors(image, polygons).tolist(), polygons))
+    integral = None
+    if color_mode == "box":
+        integral = color_integral(image)
     alist = []
     for polygon in polygons:
-        #msk = bounding_size(polygon)
-        color = polygon_color(image,polygon, mask=None)
+        msk = None
+        if integral is not None:
+            msk = bounding_size(polygon)
+        color = polygon_color(image,polygon, mask=msk, integral=integral)
         wrapper = (color, polygon)
         alist.append(wrapper)
     return alist
 
 
+# short hash of every setting that changes an output, e.g. a core.Params
+# so names of outputs differing in any of them never collide
+def output_key(*settings):
+    return content_hash(repr(settings).encode("utf-8"))[:8]
+
+
+# build output file name from input file name, mode and its parameters
+# e.g. lenna.jpg -> out_dir/lenna_delaunay_5_100_<output_key>.svg
+# output other than svg is a raster format extension, e.g. png
+def output_name(input, mode, params, compress=0, out_dir=None, output="svg"):
+    extension = svg_extension(compress)
+    if output != "svg":
+        extension = "." + output
+    name = os.path.basename(input).split('.')[0] + "_" + mode \
+            + "".join(["_" + str(param) for param in params]) + extension
+    if out_dir:
+        name = os.path.join(out_dir, name)
+    return name
+
+
+# raised by a progress callback to stop a running conversion
+class ConversionCancelled(Exception):
+    pass
+
+
+# tell progress callback which stage is about to run
+# callback may raise ConversionCancelled to stop the conversion
+def report(progress, stage):
+    if progress is not None:
+        progress(stage)
+
+
+# write colored polygons or lines to name as svg or raster image
+# svg options: precision, compress, group, quantize
+# raster options: scale, antialias
+@traced("write_output", file_size(0))
+def write_output(name, width, height, polygons=None, lines=None, output="svg", \
+                    boundry=0, precision=None, compress=0, group=0, quantize=1, \
+                    scale=1.0, antialias=0):
+    if output == "svg":
+        write_file(name, width, height, polygons=polygons, lines=lines, \
+                    boundry=boundry, precision=precision, compress=compress, \
+                    group=group, quantize=quantize)
+    else:
+        write_raster(name, width, height, polygons=polygons, lines=lines, \
+                        scale=scale, antialias=antialias, boundry=boundry)
+
+
+# run stage through cache if one is given, otherwise just compute it
+def cached_stage(cache, stage, params, compute):
+    if cache is None:
+        return compute()
+    return cache.cached(stage, params, compute)
+
+
+# read image from file
+# with cache, decoded image is cached by content hash of the file
+# raises IOError for a missing or unreadable file
+# return (image, key), key addresses image content for downstream stages
+@traced("load_image")
+def load_image(input, cache=None):
+    if cache is None:
+        image = cv2.imread(input)
+        if image is None:
+            raise IOError("could not read " + input)
+        return image, None
+    with open(input, 'rb') as file:
+        return core.decode_image(file.read(), cache)
+
+
+# point sampling shared by delaunay and voronoi
+# poisson spaces points as blue noise, dense at edges or in dark areas if
+# grey_weighted, instead of picking random edge pixels
+# return (points, key), key addresses the point set for downstream stages
+def sample_stage(im, key, cache, cull_pts_perct, cull_sbl_perct, frame, \
+                    grey_weighted, weighted, seed, progress=None, poisson=0):
+    if poisson:
+        saliency = None
+        if grey_weighted == 0:
+            report(progress, "saliency")
+            saliency = cached_stage(cache, "sobel", key, lambda: sobel(im))
+        report(progress, "sampling")
+        key = ("poisson", key, cull_pts_perct, cull_sbl_perct, grey_weighted, seed)
+        points = cached_stage(cache, "points", key, lambda: \
+                    poisson_points(im, cull_pts_perct, cull_sbl_perct, grey_weighted, \
+                                    seed, saliency))
+    elif grey_weighted == 0:
+        report(progress, "saliency")
+        saliency = cached_stage(cache, "sobel", key, lambda: sobel(im))
+        report(progress, "sampling")
+        key = ("sobel", key, cull_pts_perct, cull_sbl_perct, weighted, seed)
+        points = cached_stage(cache, "points", key, lambda: \
+                    extract_points(im, cull_sobel_prect=cull_sbl_perct, \
+                                    cull_points_perct=cull_pts_perct, \
+                                    weighted=weighted, seed=seed, saliency=saliency))
+    else:
+        report(progress, "sampling")
+        key = ("greyscale", key, seed)
+        points = cached_stage(cache, "points", key, \
+                                lambda: greyscale_points(im, seed=seed))
+    if frame:
+        key = ("frame", key, cull_pts_perct)
+        points = cached_stage(cache, "points", key, lambda: \
+                    add_frame_points(points, im, cull_pts_perct, seed=seed))
+    return points, key
+
+
+# error driven points of kind delaunay or voronoi, used instead of
+# sample_stage when a polygon budget or an rms error level is given
+# voronoi sites go to the worst pixel, which then gets a cell of its own
+# return (points, key), key addresses the point set for downstream stages
+def refine_stage(im, key, cache, kind, budget, max_error, progress=None):
+    tessellate = delaunay_polygons if kind == "delaunay" else voronoi_polygons
+    key = ("refine", key, kind, budget, max_error)
+    points = cached_stage(cache, "points", key, lambda: \
+                refine.refine_points(im, tessellate, budget, max_error, \
+                                        worst=kind == "voronoi", progress=progress))
+    return points, key
+
+
+# key addressing content of an in memory image for the stage cache
+def image_key(image):
+    return content_hash(np.ascontiguousarray(image).data) + str(image.shape)
+
+
+# traced count of shapes of a *_shapes result, stored as key
+def shapes_length(key):
+    def count(result, *args, **kwargs):
+        return {key: len(result[1] if kwargs.get("with_points") else result)}
+    return count
+
+
+# delaunay triangulation of image array, colored
+# budget (polygon count) or max_error (rms color error) refines points by
+# color error instead of sampling them
+# key addresses image content in cache, computed from image if not given
+# return colored PolygonSet of triangles
+# with_points returns tuple (points, triangles) instead
+@traced("delaunay_shapes", shapes_length("polygons"))
+def delaunay_shapes(im, cull_pts_perct=5, cull_sbl_perct=100, frame=0, \
+                    grey_weighted=0, weighted=0, poisson=0, seed=None, \
+                    color_mode="center", budget=0, max_error=0, key=None, \
+                    cache=None, progress=None, with_points=0):
+    if cache is not None and key is None:
+        key = image_key(im)
+    if budget or max_error:
+        sobel_points, key = refine_stage(im, key, cache, "delaunay", budget, \
+                                            max_error, progress)
+    else:
+        sobel_points, key = sample_stage(im, key, cache, cull_pts_perct, \
+                                            cull_sbl_perct, frame, grey_weighted, \
+                                            weighted, seed, progress, poisson)
+    report(progress, "triangulation")
+    key = ("delaunay", key)
+    triangles = cached_stage(cache, "polygons", key, lambda: \
+                    delaunay_polygons(im, sobel_points))
+    report(progress, "coloring")
+    triangles = cached_stage(cache, "colors", (key, color_mode), lambda: \
+                    associate_polygon_with_color(im, triangles, color_mode=color_mode))
+    return (sobel_points, triangles) if with_points else triangles
+
+
+# voronoi tessellation of image array, colored
+# return colored PolygonSet of facets
+# with_points returns tuple (points, facets) instead
+@traced("voronoi_shapes", shapes_length("polygons"))
+def voronoi_shapes(im, cull_pts_perct=5, cull_sbl_perct=100, frame=0, \
+                    grey_weighted=0, weighted=0, poisson=0, seed=None, \
+                    color_mode="center", budget=0, max_error=0, key=None, \
+                    cache=None, progress=None, with_points=0):
+    if cache is not None and key is None:
+        key = image_key(im)
+    if budget or max_error:
+        sobel_points, key = refine_stage(im, key, cache, "voronoi", budget, \
+                                            max_error, progress)
+    else:
+        sobel_points, key = sample_stage(im, key, cache, cull_pts_perct, \
+                                            cull_sbl_perct, frame, grey_weighted, \
+                                            weighted, seed, progress, poisson)
+    report(progress, "triangulation")
+    key = ("voronoi", key)
+    voronois = cached_stage(cache, "polygons", key, lambda: \
+                    voronoi_polygons(im, sobel_points))
+    report(progress, "coloring")
+    voronois = cached_stage(cache, "colors", (key, color_mode), lambda: \
+                    associate_polygon_with_color(im, voronois, color_mode=color_mode))
+    return (sobel_points, voronois) if with_points else voronois
+
+
+# mst of image array, colored
+# return a list of tuple (color, line)
+# with_points returns tuple (points, lines) instead
+@traced("tree_shapes", shapes_length("lines"))
+def tree_shapes(im, dist=10, skew_dist=None, cull_pts_perct=5, cull_sbl_perct=100, \
+                random=0, grey_weighted=0, weighted=0, poisson=0, seed=None, \
+                key=None, cache=None, progress=None, with_points=0):
+    if cache is not None and key is None:
+        key = image_key(im)
+    points = None
+    if random or grey_weighted:
+        points, key = sample_stage(im, key, cache, cull_pts_perct, cull_sbl_perct, \
+                                    0, grey_weighted, weighted, seed, progress, \
+                                    poisson)
+    if points is None or len(points) == 0:
+        key = ("grid", key, dist, skew_dist)
+        points = cached_stage(cache, "points", key, \
+                                lambda: grid_points(im, dist, skew_dist))
+    report(progress, "triangulation")
+    key = ("tree", key)
+    lines = cached_stage(cache, "polygons", key, lambda: euclidean_mst(points, im))
+    report(progress, "coloring")
+    lines = cached_stage(cache, "colors", key, lambda: \
+                associate_polygon_with_color(im, lines))
+    return (points, lines) if with_points else lines
+
+
+# grid pattern of image array, colored
+# return colored PolygonSet
+# with_points returns tuple (grid points, polygons) instead
+@traced("grid_shapes", shapes_length("polygons"))
+def grid_shapes(im, dist=10, sides=3, skew_dist=None, voronoi=0, \
+                color_mode="center", key=None, cache=None, progress=None, \
+                with_points=0):
+    if cache is not None and key is None:
+        key = image_key(im)
+    report(progress, "triangulation")
+    key = ("grid", key, dist, skew_dist, sides, voronoi)
+    polygons = cached_stage(cache, "polygons", key, \
+                            lambda: grid_polygons(im, dist, sides, skew_dist, voronoi))
+    report(progress, "coloring")
+    polygons = cached_stage(cache, "colors", (key, color_mode), lambda: \
+                    associate_polygon_with_color(im, polygons, color_mode=color_mode))
+    if with_points:
+        return grid_points(im, dist, skew_dist), polygons
+    return polygons
+
+
 # wrapper function to perform delaunay_triangulation on passed in Image
-# output svg
+# output svg, or raster image of format output (e.g. png) at scale
 # return output file name
+@traced("draw_dealunay")
 def draw_dealunay(input, cull_pts_perct=5, cull_sbl_perct=100, frame=0, \
-                    boundry=0, grey_weighted=0):
-    im = cv2.imread(input)
-    output = input.split('/')[-1]
-    sobel_points = None
-    if grey_weighted == 0:
-        sobel_points = extract_points(im, cull_sobel_prect=cull_sbl_perct, \
-                                        cull_points_perct=cull_pts_perct)
-    else:
-        sobel_points = greyscale_points(im)
-    if frame:
-        add_frame_points(sobel_points, im, cull_pts_perct)
-    subdiv = build_subdiv(im, sobel_points)
-    triangles = delaunay_triangulation(im, subdiv)
-    polygon_list = associate_polygon_with_color(im, triangles)
-    name = output.split('.')[0] + "_delaunay_" + \
-            str(cull_pts_perct) + "_" + str(cull_sbl_perct) + ".svg"
-
-    write_file(name, im.shape[1], im.shape[0], polygons=polygon_list, boundry=boundry)
-    return name
+                    boundry=0, grey_weighted=0, weighted=0, poisson=0, seed=None, \
+                    color_mode="center", budget=0, max_error=0, precision=None, \
+                    compress=0, group=0, quantize=1, merge=0, out_dir=None, \
+                    skip_existing=0, cache=None, progress=None, output="svg", \
+                    scale=1.0, antialias=0):
+    params = core.Params("Delaunay", cull_pts_perct, cull_sbl_perct, frame=frame, \
+                            boundry=boundry, grey_weighted=grey_weighted, \
+                            weighted=weighted, poisson=poisson, seed=seed, \
+                            color_mode=color_mode, budget=budget, \
+                            max_error=max_error, group=group, quantize=quantize, \
+                            merge=merge, precision=precision, compress=compress, \
+                            output=output, scale=scale, antialias=antialias)
+    name = output_name(input, "delaunay", [cull_pts_perct, cull_sbl_perct, \
+                        output_key(params)], compress, out_dir, output)
+    if skip_existing and os.path.exists(name):
+        return name
+    im, key = load_image(input, cache)
+    result = core.convert(im, params, cache, progress, key)
+    report(progress, "writing")
+    return result.save(name)
 
 
 # wrapper function to perform voronoi on passed in Image
-# output svg
+# output svg, or raster image of format output (e.g. png) at scale
 # return output file name
+@traced("draw_voronoi")
 def draw_voronoi(input, cull_pts_perct=5, cull_sbl_perct=100, frame=0, \
-                boundry=0, grey_weighted=0):
-    im = cv2.imread(input)
-    output = input.split('/')[-1]
-    sobel_points = extract_points(im, cull_sobel_prect=cull_sbl_perct, \
-                                    cull_points_perct=cull_pts_perct)
-    if grey_weighted == 0:
-        sobel_points = extract_points(im, cull_sobel_prect=cull_sbl_perct, \
-                                        cull_points_perct=cull_pts_perct)
-    else:
-        sobel_points = greyscale_points(im)
-    if frame:
-        add_frame_points(sobel_points, im, cull_pts_perct)
-    subdiv = build_subdiv(im, sobel_points)
-    voronois = make_voronoi(im, subdiv)
-    #pprint(voronois)
-    polygon_list = associate_polygon_with_color(im, voronois)
-    name = output.split('.')[0] + "_voronoi_" + \
-            str(cull_pts_perct) + "_" + str(cull_sbl_perct) + ".svg"
-    write_file(name, im.shape[1], im.shape[0], polygons=polygon_list, boundry=boundry)
-    return name
+                boundry=0, grey_weighted=0, weighted=0, poisson=0, seed=None, \
+                color_mode="center", budget=0, max_error=0, precision=None, \
+                compress=0, group=0, quantize=1, merge=0, out_dir=None, \
+                skip_existing=0, cache=None, progress=None, output="svg", \
+                scale=1.0, antialias=0):
+    params = core.Params("Voronoi", cull_pts_perct, cull_sbl_perct, frame=frame, \
+                            boundry=boundry, grey_weighted=grey_weighted, \
+                            weighted=weighted, poisson=poisson, seed=seed, \
+                            color_mode=color_mode, budget=budget, \
+                            max_error=max_error, group=group, quantize=quantize, \
+                            merge=merge, precision=precision, compress=compress, \
+                            output=output, scale=scale, antialias=antialias)
+    name = output_name(input, "voronoi", [cull_pts_perct, cull_sbl_perct, \
+                        output_key(params)], compress, out_dir, output)
+    if skip_existing and os.path.exists(name):
+        return name
+    im, key = load_image(input, cache)
+    result = core.convert(im, params, cache, progress, key)
+    report(progress, "writing")
+    return result.save(name)
 
 
 # wrapper function to prodeuce MST on passed in Image
-# output svg
+# output svg, or raster image of format output (e.g. png) at scale
 # return output file name
+@traced("draw_tree")
 def draw_tree(input, dist=10, skew_dist=None, cull_pts_perct=5, cull_sbl_perct=100, \
-                random=0, grey_weighted=0):
-    im = cv2.imread(input)
-    output = input.split('/')[-1]
-    points = None
-    if random:
-        points = extract_points(im, cull_sobel_prect=cull_sbl_perct, \
-                                    cull_points_perct=cull_pts_perct)
-    if grey_weighted:
-        points = greyscale_points(im)
-    if not points:
-        print("ortho tree")
-        points = produce_grid(im, dist, skew_dist)
-        pts = []
-        for row in points:
-            for p in row:
-                #print(p)
-                pts.append(tuple(p))
-        points = pts
-        #print(points)
-    lines = euclidean_mst(points, im)
-    polygon_list = associate_polygon_with_color(im, lines)
-    name = output.split('.')[0] + "_tree_" + str(dist) + ".svg"
-    write_file(name, im.shape[1], im.shape[0], lines=polygon_list)
-    return name
+                random=0, grey_weighted=0, weighted=0, poisson=0, seed=None, \
+                precision=None, compress=0, out_dir=None, skip_existing=0, cache=None, \
+                progress=None, output="svg", scale=1.0, antialias=0):
+    # grey weighted sampling makes a random tree even without random
+    mode = "Random-Tree" if random or grey_weighted else "Ortho-Tree"
+    params = core.Params(mode, cull_pts_perct, cull_sbl_perct, dist, skew_dist or 0, \
+                            grey_weighted=grey_weighted, weighted=weighted, \
+                            poisson=poisson, seed=seed, precision=precision, \
+                            compress=compress, output=output, scale=scale, \
+                            antialias=antialias)
+    name = output_name(input, mode.lower(), [dist, output_key(params)], compress, \
+                        out_dir, output)
+    if skip_existing and os.path.exists(name):
+        return name
+    im, key = load_image(input, cache)
+    result = core.convert(im, params, cache, progress, key)
+    report(progress, "writing")
+    return result.save(name)
 
 
 # wrapper function to prodeuce grids pattern on passed in Image
-# output svg
+# output svg, or raster image of format output (e.g. png) at scale
 # return output file name
-def draw_grid(input, dist=10, sides=3, skew_dist=None, boundry=0, voronoi=0):
-    im = cv2.imread(input)
-    output = input.split('/')[-1]
-    points = produce_grid(im, dist, skew_dist)
-    polygons = polygons_from_grid(points, sides)
+@traced("draw_grid")
+def draw_grid(input, dist=10, sides=3, skew_dist=None, boundry=0, voronoi=0, \
+                color_mode="center", precision=None, compress=0, \
+                group=0, quantize=1, merge=0, out_dir=None, skip_existing=0, \
+                cache=None, progress=None, output="svg", scale=1.0, antialias=0):
+    mode = "Voronoi-Grid" if voronoi else "Tri-Grid" if sides == 3 else "Square-Grid"
+    params = core.Params(mode, dist=dist, skew=skew_dist or 0, boundry=boundry, \
+                            color_mode=color_mode, group=group, quantize=quantize, \
+                            merge=merge, precision=precision, compress=compress, \
+                            output=output, scale=scale, antialias=antialias)
+    name = output_name(input, mode.lower(), [dist, skew_dist or 0, \
+                        output_key(params)], compress, out_dir, output)
+    if skip_existing and os.path.exists(name):
+        return name
+    im, key = load_image(input, cache)
+    result = core.convert(im, params, cache, progress, key)
+    report(progress, "writing")
+    return result.save(name)
+
+
+# flattened grid points of produce_grid
+# return (N, 2) int array of points (x,y)
+def grid_points(image, dist, skew_dist=None):
+    return produce_grid(image, dist, skew_dist).reshape(-1, 2)
+
+
+# triangles or quadlaterals of grid, or voronoi facets of grid points
+def grid_polygons(image, dist, sides=3, skew_dist=None, voronoi=0):
     if voronoi:
-        pts = []
-        for row in points:
-            for p in row:
-                pts.append(tuple(p))
-        subdiv = build_subdiv(im, pts)
-        polygons = make_voronoi(im, subdiv)
-    polygon_list = associate_polygon_with_color(im, polygons)
-    name = output.split('.')[0] + "_grid_" + str(sides) + "_" + str(skew_dist) + ".svg"
-    write_file(name, im.shape[1], im.shape[0], polygons=polygon_list, boundry=boundry)
-    return name
+        return voronoi_polygons(image, grid_points(image, dist, skew_dist))
+    return polygons_from_grid(produce_grid(image, dist, skew_dist), sides)
+
+
+# modes offered by gui and command line
+MODES = ["Delaunay", "Voronoi", "Tri-Grid", "Square-Grid", "Voronoi-Grid", \
+            "Ortho-Tree", "Random-Tree"]
+
+
+# map gui mode to kind of shapes and the arguments of its *_shapes function
+# sampling options (weighted, poisson, seed) go to delaunay, voronoi and trees
+# color_mode goes to all but trees, refinement (budget, max_error) to
+# delaunay and voronoi
+# return tuple (kind, arguments)
+def mode_arguments(mode, cull_pts=2, cull_sbl=100, dist=10, skew=0, frame=0, \
+                    grey_weighted=0, weighted=0, seed=None, color_mode="center", \
+                    poisson=0, budget=0, max_error=0):
+    sampling = dict(cull_pts_perct=cull_pts, cull_sbl_perct=cull_sbl, \
+                    weighted=weighted, poisson=poisson, seed=seed)
+    if mode == "Delaunay":
+        return "delaunay", dict(frame=frame, grey_weighted=grey_weighted, \
+                                color_mode=color_mode, budget=budget, \
+                                max_error=max_error, **sampling)
+    elif mode == "Voronoi":
+        return "voronoi", dict(frame=frame, grey_weighted=grey_weighted, \
+                                color_mode=color_mode, budget=budget, \
+                                max_error=max_error, **sampling)
+    elif mode == "Tri-Grid":
+        return "grid", dict(dist=dist, sides=3, skew_dist=skew, color_mode=color_mode)
+    elif mode == "Square-Grid":
+        return "grid", dict(dist=dist, sides=4, skew_dist=skew, color_mode=color_mode)
+    elif mode == "Voronoi-Grid":
+        return "grid", dict(dist=dist, sides=4, skew_dist=skew, voronoi=1, \
+                            color_mode=color_mode)
+    elif mode == "Ortho-Tree":
+        return "tree", dict(dist=dist, skew_dist=skew, cull_pts_perct=cull_pts, \
+                            cull_sbl_perct=cull_sbl, random=0, grey_weighted=0)
+    elif mode == "Random-Tree":
+        return "tree", dict(dist=dist, skew_dist=skew, random=1, \
+                            grey_weighted=grey_weighted, **sampling)
+    raise ValueError("Mode Error: " + str(mode))
+
+
+SHAPE_FUNCTIONS = {"delaunay": delaunay_shapes, "voronoi": voronoi_shapes, \
+                    "grid": grid_shapes, "tree": tree_shapes}
+DRAW_FUNCTIONS = {"delaunay": draw_dealunay, "voronoi": draw_voronoi, \
+                    "grid": draw_grid, "tree": draw_tree}
+
+
+# produce colored shapes of mode from image array, nothing written to disk
+# return tuple (polygons, lines) of (color, points) lists, one of them None
+def mode_shapes(im, mode, cull_pts=2, cull_sbl=100, dist=10, skew=0, frame=0, \
+                grey_weighted=0, weighted=0, seed=None, color_mode="center", \
+                key=None, cache=None, progress=None, poisson=0, budget=0, \
+                max_error=0):
+    kind, arguments = mode_arguments(mode, cull_pts, cull_sbl, dist, skew, frame, \
+                                        grey_weighted, weighted, seed, color_mode, \
+                                        poisson, budget, max_error)
+    shapes = SHAPE_FUNCTIONS[kind](im, key=key, cache=cache, progress=progress, \
+                                    **arguments)
+    if kind == "tree":
+        return None, shapes
+    return shapes, None
+
+
+# call the draw function of mode with gui parameters
+# polygon output options (boundry, group, quantize, merge) go to all but trees
+# return output file name
+def draw_mode(input, mode, cull_pts=2, cull_sbl=100, dist=10, skew=0, \
+                frame=0, boundry=0, grey_weighted=0, weighted=0, seed=None, \
+                color_mode="center", group=0, quantize=1, precision=None, \
+                compress=0, out_dir=None, skip_existing=0, cache=None, \
+                progress=None, output="svg", scale=1.0, antialias=0, poisson=0, \
+                budget=0, max_error=0, merge=0):
+    kind, arguments = mode_arguments(mode, cull_pts, cull_sbl, dist, skew, frame, \
+                                        grey_weighted, weighted, seed, color_mode, \
+                                        poisson, budget, max_error)
+    if kind != "tree":
+        arguments.update(boundry=boundry, group=group, quantize=quantize, merge=merge)
+    return DRAW_FUNCTIONS[kind](input, precision=precision, compress=compress, \
+                                out_dir=out_dir, skip_existing=skip_existing, \
+                                cache=cache, progress=progress, output=output, \
+                                scale=scale, antialias=antialias, **arguments)
@@ -37,7 +37,7 @@ grid size of for Tri-grid and Square-grid, in pixel_count
 SKEW DISTANCE:
 recommended bewtween [0 - GRIDSIZE]
 skew every other line by number of pixel_count, you may try go over recommeded
-skew_dist, it might crash... and doesn't work well near right hand boundry
+skew_dist, grid columns skewed past right hand boundry are trimmed
 
 PIN_FRAME:
 for delaunay and voronoi. if produced polygons does not fill the whole
@@ -0,0 +1,221 @@
+import numpy as np
+from polygons import PolygonSet, polygons_from_list, concatenate_polygons
+from triangulation import site_keys
+from tracing import traced, argument_length
+
+'''
+This file contains merging of neighbouring polygons of the same fill.
+Polygons sharing an edge are joined by union-find when their colors snap
+to the same multiple of a tolerance, then the outline of every joined
+region is traced from the edges no other member shares. Holes are tied
+to the outline by a bridge walked both ways, so a region stays a single
+polygon and fills the same under nonzero and evenodd rules
+'''
+
+
+# index of the next vertex of every vertex within its polygon
+def next_vertex(polygons):
+    following = np.arange(1, len(polygons.coords) + 1)
+    sizes = polygons.sizes()
+    ends = polygons.offsets[1:][sizes > 0] - 1
+    following[ends] = polygons.offsets[:-1][sizes > 0]
+    return following
+
+
+# signed area of every polygon, positive for clockwise on screen (y down)
+# return (N,) float64 array
+def signed_areas(polygons, following=None):
+    if following is None:
+        following = next_vertex(polygons)
+    coords = polygons.coords.astype(np.float64)
+    cross = coords[:,0] * coords[following,1] - coords[following,0] * coords[:,1]
+    areas = np.zeros(len(polygons), dtype=np.float64)
+    filled = np.flatnonzero(polygons.sizes() > 0)
+    if len(filled):
+        areas[filled] = np.add.reduceat(cross, polygons.offsets[filled]) / 2
+    return areas
+
+
+# union-find backed by flat parent/rank lists, shared with kruskal
+# joins the sets of every (u, v) of pairs in order, parent starts as
+# list(range(count)) and is updated in place
+# yield position of every pair that joined two sets
+def join_pairs(parent, pairs):
+    rank = [0] * len(parent)
+    for i, (u, v) in enumerate(pairs):
+        while parent[u] != u:
+            parent[u] = parent[parent[u]]
+            u = parent[u]
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        if u == v:
+            continue
+        if rank[u] < rank[v]:
+            u, v = v, u
+        parent[v] = u
+        if rank[u] == rank[v]:
+            rank[u] += 1
+        yield i
+
+
+# join polygons of pairs
+# return (N,) intp root of every polygon
+def union_pairs(count, pairs):
+    parent = list(range(count))
+    for _ in join_pairs(parent, pairs.tolist()):
+        pass
+    roots = np.array(parent, dtype=np.intp)
+    # parents point at roots after at most log(count) halvings
+    while True:
+        grand = roots[roots]
+        if (grand == roots).all():
+            return roots
+        roots = grand
+
+
+# closed loops of directed boundary edges (start, end, region)
+# where a region touches itself at a vertex, incoming and outgoing
+# edges there are paired in sorted order, any pairing closes the loops
+# return (vertex ids of all loops one after another, loop offsets,
+#         region of every loop)
+def trace_loops(starts, ends, regions):
+    out_order = np.lexsort((starts, regions))
+    in_order = np.lexsort((ends, regions))
+    following = np.empty(len(starts), dtype=np.intp)
+    following[in_order] = out_order
+    following = following.tolist()
+    seen = [False] * len(starts)
+    walk = []
+    offsets = [0]
+    for first in range(len(starts)):
+        if seen[first]:
+            continue
+        edge = first
+        while not seen[edge]:
+            seen[edge] = True
+            walk.append(edge)
+            edge = following[edge]
+        offsets.append(len(walk))
+    walk = np.array(walk, dtype=np.intp)
+    offsets = np.array(offsets, dtype=np.intp)
+    return starts[walk], offsets, regions[walk[offsets[:-1]]]
+
+
+# loops without vertices in the middle of a straight run, loops left
+# with less than 3 vertices are kept whole
+# return PolygonSet
+def straighten(loops):
+    following = next_vertex(loops)
+    previous = np.empty_like(following)
+    previous[following] = np.arange(len(following))
+    coords = loops.coords.astype(np.float64)
+    before = coords - coords[previous]
+    after = coords[following] - coords
+    cross = before[:,0] * after[:,1] - before[:,1] * after[:,0]
+    keep = (cross != 0) | ((before * after).sum(axis=1) <= 0)
+    owners = np.repeat(np.arange(len(loops)), loops.sizes())
+    kept = np.bincount(owners, weights=keep, minlength=len(loops))
+    keep |= (kept < 3)[owners]
+    sizes = np.bincount(owners[keep], minlength=len(loops))
+    return PolygonSet(loops.coords[keep], np.concatenate(([0], np.cumsum(sizes))))
+
+
+# outline of a region from its loops, largest loop first, every other
+# loop reached by a bridge from and back to the first vertex
+# return (K, 2) float32 array
+def join_loops(loops, areas):
+    order = np.argsort(-np.abs(areas), kind="stable").tolist()
+    outer = loops.coords[loops.offsets[order[0]]:loops.offsets[order[0]+1]]
+    parts = [outer]
+    for i in order[1:]:
+        loop = loops.coords[loops.offsets[i]:loops.offsets[i+1]]
+        parts += [outer[:1], loop, loop[:1]]
+    return np.concatenate(parts)
+
+
+# merge neighbouring polygons of a colored PolygonSet whose colors round
+# to the same multiple of tolerance into one polygon per region
+# a region is filled with the area weighted mean of its members, other
+# polygons are kept as they are, in order of their first member
+# a region is painted at once, so pixels on edges it shares with others
+# may go to a different polygon than before, even for tolerance 1
+# return colored PolygonSet
+@traced("merge_polygons", argument_length(0, "polygons"))
+def merge_polygons(polygons, tolerance=1):
+    count = len(polygons)
+    if count < 2:
+        return polygons
+    following = next_vertex(polygons)
+    areas = signed_areas(polygons, following)
+    owners = np.repeat(np.arange(count), polygons.sizes())
+    _, vertex = np.unique(site_keys(polygons.coords), return_inverse=True)
+    vertex = vertex.ravel()
+    starts = vertex
+    ends = vertex[following]
+    # edges run clockwise around every polygon
+    flip = areas[owners] < 0
+    starts, ends = np.where(flip, ends, starts), np.where(flip, starts, ends)
+    edges = np.flatnonzero(starts != ends)
+    starts, ends, owners = starts[edges], ends[edges], owners[edges]
+    low = np.minimum(starts, ends).astype(np.int64)
+    keys = (low << 32) | np.maximum(starts, ends)
+    order = np.argsort(keys, kind="stable")
+    # an edge is shared by exactly two polygons running it both ways,
+    # edges of overlapping polygons are left on the outline
+    equal = np.concatenate(([False], keys[order[1:]] == keys[order[:-1]], [False]))
+    shared = np.flatnonzero(equal[1:-1] & ~equal[:-2] & ~equal[2:])
+    first, second = order[shared], order[shared + 1]
+    opposite = starts[first] == ends[second]
+    first, second = first[opposite], second[opposite]
+    snapped = np.round(polygons.colors / max(tolerance, 1)).astype(np.int64)
+    same = (snapped[owners[first]] == snapped[owners[second]]).all(axis=1)
+    pairs = np.column_stack((owners[first][same], owners[second][same]))
+    roots = union_pairs(count, pairs)
+    _, region, sizes = np.unique(roots, return_inverse=True, return_counts=True)
+    region = region.ravel()
+    merged = sizes[region] > 1
+    if not merged.any():
+        return polygons
+
+    # edges whose twin belongs to the same region are inside it
+    inside = np.zeros(len(keys), dtype=bool)
+    joined = region[owners[first]] == region[owners[second]]
+    inside[first[joined]] = True
+    inside[second[joined]] = True
+    boundary = np.flatnonzero(~inside & merged[owners])
+    points = np.zeros((vertex.max() + 1, 2), dtype=np.float32)
+    points[vertex] = polygons.coords
+    walk, offsets, loop_regions = trace_loops(starts[boundary], ends[boundary], \
+                                                region[owners[boundary]])
+    loops = straighten(PolygonSet(points[walk], offsets))
+    # a region of one loop is that loop, holes are bridged in
+    by_region = np.argsort(loop_regions, kind="stable")
+    regions, first_loop, loop_counts = np.unique(loop_regions[by_region], \
+                                        return_index=True, return_counts=True)
+    outlines = loops.take(by_region[first_loop])
+    several = np.flatnonzero(loop_counts > 1)
+    if len(several):
+        loop_areas = signed_areas(loops)
+        bridged = []
+        for i in several.tolist():
+            index = by_region[first_loop[i]:first_loop[i] + loop_counts[i]]
+            bridged.append(join_loops(loops.take(index), loop_areas[index]))
+        single = np.flatnonzero(loop_counts == 1)
+        outlines = concatenate_polygons([outlines.take(single), \
+                                        polygons_from_list(bridged)]) \
+                    .take(np.argsort(np.concatenate((single, several)), kind="stable"))
+
+    weights = np.abs(areas)
+    weights = np.where(np.bincount(region, weights=weights)[region] > 0, weights, 1)
+    total = np.bincount(region, weights=weights)
+    colors = np.column_stack([np.bincount(region, weights=weights \
+                                * polygons.colors[:,i]) / total for i in range(3)])
+    colors = np.round(colors[regions]).astype(np.uint8)
+    kept = np.flatnonzero(~merged)
+    # every region takes the place of its first member
+    first_member = np.full(len(sizes), count, dtype=np.intp)
+    np.minimum.at(first_member, region, np.arange(count))
+    places = np.concatenate((kept, first_member[regions]))
+    result = concatenate_polygons([polygons.take(kept), outlines.with_colors(colors)])
+    return result.take(np.argsort(places, kind="stable"))
@@ -0,0 +1,160 @@
+import math
+import cv2
+import numpy as np
+from tracing import traced, result_length
+
+'''
+This file contains the poisson disk (blue noise) point sampler. Every
+pixel has a radius, small where the image has detail and large where it
+is flat, and no two points are closer than the radius at the later one.
+Bridson's algorithm grows the point set outward from active points; a
+background grid of cells holding at most one point answers the spacing
+checks, and all active points are extended at once with numpy, so the
+cost is near linear in the number of points
+'''
+
+
+# density in [0, 1] from sobel saliency, 1 from threshold upward
+# edges are widened by spread pixels and smoothed, so the radius follows
+# an edge instead of flickering across it
+# return 2d float32 array
+def saliency_density(saliency, threshold=100, spread=3):
+    density = np.minimum(saliency.astype(np.float32) / max(threshold, 1), 1)
+    size = 2 * int(math.ceil(spread)) + 1
+    density = cv2.dilate(density, np.ones((size, size), np.uint8))
+    return cv2.GaussianBlur(density, (0, 0), max(spread / 2, 0.5))
+
+
+# density in [0, 1] from darkness, darker areas keep more points like
+# greyscale_points
+# return 2d float32 array
+def grey_density(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    return 1 - gray / 255
+
+
+# radius of every pixel, min_radius where density is 1 and max_radius
+# where it is 0
+# return 2d float32 array
+def radius_map(density, min_radius, max_radius):
+    return (max_radius + (min_radius - max_radius) * density).astype(np.float32)
+
+
+# radii from density percentage like cull_pts_perct, min radius shrinks
+# with the square root of density, as spacing does for point count
+# return (min_radius, max_radius)
+def density_radii(image, cull_perct):
+    min_radius = max(1.0, 15 / math.sqrt(max(cull_perct, 0.01)))
+    max_radius = max(min_radius, min(4 * min_radius, min(image.shape[:2]) / 8))
+    return min_radius, max_radius
+
+
+# indices of grid points conflicting with each candidate
+# a candidate conflicts with any point closer than its own radius
+# return boolean array, True where candidate is free
+def grid_free(grid, points, cell, pad, candidates, radii):
+    free = np.ones(len(candidates), dtype=bool)
+    cells = (candidates / cell).astype(np.intp) + pad
+    reach = np.ceil(radii / cell).astype(np.intp)
+    # candidates are grouped by reach, so small radii look at few cells
+    for r in np.unique(reach).tolist():
+        group = np.flatnonzero(reach == r)
+        offsets = np.arange(-r, r + 1)
+        rows = cells[group,1][:,np.newaxis,np.newaxis] + offsets[:,np.newaxis]
+        cols = cells[group,0][:,np.newaxis,np.newaxis] + offsets
+        near = grid[rows, cols].reshape(len(group), -1)
+        occupied = near >= 0
+        diff = points[np.where(occupied, near, 0)] - candidates[group][:,np.newaxis]
+        close = occupied & ((diff * diff).sum(axis=2) < (radii[group] ** 2)[:,np.newaxis])
+        free[group] = ~close.any(axis=1)
+    return free
+
+
+# candidates that keep their spacing to each other, conflicts go to the
+# candidate of higher priority, a pair conflicts when closer than the
+# larger of their radii
+# return boolean array of kept candidates
+def batch_free(candidates, radii, priority):
+    diff = candidates[:,np.newaxis] - candidates
+    limit = np.maximum(radii[:,np.newaxis], radii)
+    close = (diff * diff).sum(axis=2) < limit * limit
+    beaten = close & (priority[np.newaxis,:] > priority[:,np.newaxis])
+    return ~beaten.any(axis=1)
+
+
+# poisson disk samples over a radius map
+# attempts is the number of failed candidates after which a point stops
+# growing, batch caps the active points extended at once
+# return (N, 2) float64 array of points (x,y)
+@traced("poisson_disk", result_length("points"))
+def poisson_disk(radius, seed=None, attempts=20, batch=1024):
+    rng = np.random.default_rng(seed)
+    height, width = radius.shape
+    cell = float(radius.min()) / math.sqrt(2)
+    # padding by the largest reach keeps every grid lookup inside
+    pad = int(math.ceil(float(radius.max()) / cell)) + 1
+    grid = np.full((int(height / cell) + 2 * pad + 1, int(width / cell) + 2 * pad + 1), \
+                    -1, dtype=np.intp)
+    capacity = 1024
+    points = np.empty((capacity, 2), dtype=np.float64)
+    failures = np.zeros(capacity, dtype=np.intp)
+    first = rng.random(2) * (width, height)
+    points[0] = first
+    grid[int(first[1] / cell) + pad, int(first[0] / cell) + pad] = 0
+    count = 1
+    active = np.array([0], dtype=np.intp)
+    while len(active):
+        pick = active if len(active) <= batch else \
+                rng.choice(active, size=batch, replace=False)
+        parents = points[pick]
+        parent_radii = radius[parents[:,1].astype(np.intp), parents[:,0].astype(np.intp)]
+        # one candidate per parent in the annulus between r and 2r
+        angle = rng.random(len(pick)) * 2 * math.pi
+        distance = parent_radii * (1 + rng.random(len(pick)))
+        candidates = parents + np.column_stack((np.cos(angle), np.sin(angle))) \
+                                * distance[:,np.newaxis]
+        kept = (candidates[:,0] >= 0) & (candidates[:,0] < width) \
+                & (candidates[:,1] >= 0) & (candidates[:,1] < height)
+        index = np.flatnonzero(kept)
+        radii = radius[candidates[index,1].astype(np.intp), \
+                        candidates[index,0].astype(np.intp)]
+        free = grid_free(grid, points, cell, pad, candidates[index], radii)
+        index = index[free]
+        radii = radii[free]
+        index = index[batch_free(candidates[index], radii, rng.random(len(index)))]
+        accepted = np.zeros(len(pick), dtype=bool)
+        accepted[index] = True
+        failures[pick[~accepted]] += 1
+        new = candidates[index]
+        if count + len(new) > capacity:
+            capacity = 2 * (count + len(new))
+            points = np.resize(points, (capacity, 2))
+            failures = np.concatenate((failures[:count], \
+                                        np.zeros(capacity - count, dtype=np.intp)))
+        ids = np.arange(count, count + len(new))
+        points[ids] = new
+        failures[ids] = 0
+        grid[(new[:,1] / cell).astype(np.intp) + pad, \
+                (new[:,0] / cell).astype(np.intp) + pad] = ids
+        count += len(new)
+        active = np.concatenate((active[failures[active] < attempts], ids))
+    return points[:count]
+
+
+# poisson disk points of image, dense where sobel saliency reaches
+# threshold, or where image is dark if grey
+# density is a percentage like cull_pts_perct of extract_points
+# return (N, 2) int32 array of points (x,y)
+@traced("poisson_points", result_length("points"))
+def poisson_points(image, cull_perct=5, threshold=100, grey=0, seed=None, \
+                    saliency=None):
+    min_radius, max_radius = density_radii(image, cull_perct)
+    if grey:
+        density = grey_density(image)
+    else:
+        if saliency is None:
+            from lowpoly import sobel
+            saliency = sobel(image)
+        density = saliency_density(saliency, threshold, min_radius)
+    points = poisson_disk(radius_map(density, min_radius, max_radius), seed)
+    return points.astype(np.int32)
@@ -0,0 +1,155 @@
+import numpy as np
+
+'''
+This file contains PolygonSet, the array backed container polygons are
+passed in between stages. All vertices share one float32 buffer indexed
+by an offsets array (compressed sparse row), colors are one uint8 array,
+so a set of a million triangles is a handful of numpy arrays instead of
+millions of python lists and floats
+'''
+
+
+# polygons in compressed sparse row layout
+# coords  (V, 2) float32 vertices of all polygons, one after another
+# offsets (N+1,) intp, polygon i is coords[offsets[i]:offsets[i+1]]
+# colors  (N, 3) uint8 rgb of each polygon, None until colored
+# indexing and iterating gives flat [x,y,x,y...] views like a list of
+# polygons, shapes() gives (color, points) like colored polygon lists
+class PolygonSet:
+    def __init__(self, coords, offsets, colors=None):
+        self.coords = np.ascontiguousarray(coords, dtype=np.float32).reshape(-1, 2)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.intp)
+        self.colors = None
+        if colors is not None:
+            self.colors = np.ascontiguousarray(colors, dtype=np.uint8).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i+1]].ravel()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        colors = 0 if self.colors is None else self.colors.nbytes
+        return self.coords.nbytes + self.offsets.nbytes + colors
+
+    # vertex count of every polygon
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    # vertex count shared by all polygons, 0 if counts differ
+    def uniform_size(self):
+        sizes = self.sizes()
+        if len(sizes) and (sizes == sizes[0]).all():
+            return int(sizes[0])
+        return 0
+
+    # sum of vertices of every polygon, empty polygons sum to 0
+    # return (N, 2) float64 array
+    def vertex_sums(self):
+        sums = np.zeros((len(self), 2), dtype=np.float64)
+        filled = np.flatnonzero(self.sizes() > 0)
+        if len(filled):
+            sums[filled] = np.add.reduceat(self.coords.astype(np.float64), \
+                                            self.offsets[filled], axis=0)
+        return sums
+
+    # mean vertex of every polygon
+    # return (N, 2) float64 array
+    def centers(self):
+        return self.vertex_sums() / np.maximum(self.sizes(), 1)[:,np.newaxis]
+
+    # bounding box of every polygon
+    # return (N, 2) float32 arrays of minimum and maximum (x, y)
+    def bounds(self):
+        starts = np.minimum(self.offsets[:-1], max(len(self.coords) - 1, 0))
+        if len(self.coords) == 0:
+            empty = np.zeros((len(self), 2), dtype=np.float32)
+            return empty, empty
+        return np.minimum.reduceat(self.coords, starts, axis=0), \
+                np.maximum.reduceat(self.coords, starts, axis=0)
+
+    # (color, points) of every polygon, points a flat view
+    def shapes(self):
+        for i in range(len(self)):
+            yield self.colors[i], self[i]
+
+    # same polygons with colors
+    def with_colors(self, colors):
+        return PolygonSet(self.coords, self.offsets, colors)
+
+    # polygons moved by (dx, dy), colors kept
+    def translated(self, offset):
+        return PolygonSet(self.coords + np.asarray(offset, dtype=np.float32), \
+                            self.offsets, self.colors)
+
+    # polygons with every vertex clamped into width x height image
+    def clipped(self, width, height):
+        upper = np.array([width - 1, height - 1], dtype=np.float32)
+        return PolygonSet(np.clip(self.coords, 0, upper), self.offsets, self.colors)
+
+    # subset of polygons by index or boolean mask, in given order
+    def take(self, index):
+        index = np.arange(len(self))[index]
+        sizes = self.sizes()[index]
+        offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.intp)
+        vertex = np.repeat(self.offsets[index] - offsets[:-1], sizes) \
+                    + np.arange(offsets[-1])
+        colors = None if self.colors is None else self.colors[index]
+        return PolygonSet(self.coords[vertex], offsets, colors)
+
+
+# fill colors of a colored PolygonSet in order of first use, snapped to
+# multiples of quantize like svg.quantize_color
+# return list of tuple ((r,g,b), index array of polygons of that color)
+def color_groups(polygons, quantize=1):
+    if len(polygons) == 0:
+        return []
+    colors = polygons.colors.astype(np.int64)
+    if quantize > 1:
+        colors = np.minimum(255, np.round(colors / quantize).astype(np.int64) * quantize)
+    keys = (colors[:,0] << 16) | (colors[:,1] << 8) | colors[:,2]
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    rank = np.argsort(np.argsort(first))[inverse.ravel()]
+    order = np.argsort(rank, kind="stable")
+    bounds = np.cumsum(np.bincount(rank))[:-1]
+    return [(tuple(colors[index[0]].tolist()), index) \
+            for index in np.split(order, bounds)]
+
+
+# polygon set of (N, 2K) array, one polygon [x,y,x,y...] per row
+def polygons_from_rows(rows, colors=None):
+    rows = np.asarray(rows)
+    count = len(rows)
+    size = rows.shape[1] // 2 if rows.ndim == 2 else 0
+    return PolygonSet(rows.reshape(-1, 2), np.arange(count + 1) * size, colors)
+
+
+# polygon set of a list of polygons, each a flat [x,y,x,y...] sequence
+# or a (K, 2) array
+def polygons_from_list(polygons, colors=None):
+    if len(polygons) == 0:
+        return PolygonSet(np.empty((0, 2)), [0], colors)
+    parts = [np.asarray(polygon, dtype=np.float32).reshape(-1, 2) \
+                for polygon in polygons]
+    offsets = np.concatenate(([0], np.cumsum([len(part) for part in parts])))
+    return PolygonSet(np.concatenate(parts), offsets, colors)
+
+
+# polygon sets joined one after another, colors kept if all are colored
+def concatenate_polygons(sets):
+    sets = list(sets)
+    if not sets:
+        return PolygonSet(np.empty((0, 2)), [0])
+    starts = np.cumsum([0] + [len(s.coords) for s in sets])
+    offsets = np.concatenate([[0]] + [s.offsets[1:] + start \
+                                        for s, start in zip(sets, starts)])
+    colors = None
+    if all(s.colors is not None for s in sets):
+        colors = np.concatenate([s.colors for s in sets])
+    return PolygonSet(np.concatenate([s.coords for s in sets]), offsets, colors)
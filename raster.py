@@ -0,0 +1,106 @@
+import cv2
+import numpy as np
+from polygons import PolygonSet, color_groups
+from tracing import traced, file_size
+
+'''
+This file contains functions that render dataset into raster image
+'''
+
+# raster formats offered for output, encoded by opencv by extension
+RASTER_FORMATS = ("png", "jpg", "webp", "bmp", "tif")
+
+
+# flattened points [x,y,x,y...] to int32 vertex array for opencv drawing
+# coordinates are scaled and keep 4 fractional bits (shift=4)
+def scaled_vertices(points, scale):
+    pts = np.asarray(points, dtype=np.float64).reshape(-1, 2) * (scale * 16)
+    return np.round(pts).astype(np.int32)
+
+
+# bucket shapes by color so each color is drawn with one opencv call
+# return dict {(b,g,r): [vertices, ...]}
+def group_by_color(shapes, scale, uni_color=None):
+    groups = {}
+    for color, points in shapes:
+        if uni_color is not None:
+            color = uni_color
+        bgr = (int(color[2]), int(color[1]), int(color[0]))
+        groups.setdefault(bgr, []).append(scaled_vertices(points, scale))
+    return groups
+
+
+# bucket polygons of a colored PolygonSet by color, vertices are views
+# into one scaled vertex array
+# return dict {(b,g,r): [vertices, ...]}
+def group_polygon_set(polygons, scale):
+    pts = scaled_vertices(polygons.coords, scale)
+    offsets = polygons.offsets
+    return {(color[2], color[1], color[0]): \
+                [pts[offsets[i]:offsets[i+1]] for i in index.tolist()] \
+            for color, index in color_groups(polygons)}
+
+
+# fill polygons onto canvas, batched per color
+# polygons is a colored PolygonSet or an iterable of (color, points)
+# line draws outlines on white fill instead, like svg edge only mode
+def render_polygons(canvas, polygons, scale=1.0, line=0, antialias=0):
+    line_type = cv2.LINE_AA if antialias else cv2.LINE_8
+    if isinstance(polygons, PolygonSet):
+        groups = group_polygon_set(polygons, scale)
+    else:
+        groups = group_by_color(polygons, scale)
+    if line:
+        outlines = [pts for group in groups.values() for pts in group]
+        cv2.fillPoly(canvas, outlines, (254,254,254), line_type, shift=4)
+        cv2.polylines(canvas, outlines, True, (1,1,1), 1, line_type, shift=4)
+        return canvas
+    for bgr, group in groups.items():
+        cv2.fillPoly(canvas, group, bgr, line_type, shift=4)
+    return canvas
+
+
+# draw lines (color, [s_x, s_y, e_x, e_y]) onto canvas, batched per color
+def render_lines(canvas, lines, scale=1.0, thickness=1, uni_color=None, antialias=0):
+    line_type = cv2.LINE_AA if antialias else cv2.LINE_8
+    for bgr, group in group_by_color(lines, scale, uni_color).items():
+        cv2.polylines(canvas, group, False, bgr, thickness, line_type, shift=4)
+    return canvas
+
+
+# render polygons and lines on white canvas of image size times scale
+# return BGR uint8 image
+def render_image(width, height, polygons=None, lines=None, scale=1.0, \
+                    antialias=0, boundry=0, thickness=None, uni_color=None):
+    canvas = np.full((max(1, int(round(height*scale))), \
+                        max(1, int(round(width*scale))), 3), 254, dtype=np.uint8)
+    if polygons is not None:
+        render_polygons(canvas, polygons, scale, line=boundry, antialias=antialias)
+    if lines is not None:
+        thickness = thickness or max(1, int(round(scale)))
+        render_lines(canvas, lines, scale, thickness, uni_color, antialias)
+    return canvas
+
+
+# render and write raster image, format follows path extension (png, jpg ...)
+@traced("write_raster", file_size(0))
+def write_raster(path, width, height, polygons=None, lines=None, scale=1.0, \
+                    antialias=0, boundry=0, thickness=None, uni_color=None):
+    image = render_image(width, height, polygons, lines, scale, antialias, \
+                            boundry, thickness, uni_color)
+    if not cv2.imwrite(path, image):
+        raise IOError("could not write " + path)
+    return path
+
+
+# render and encode raster image in format (png, jpg ...)
+# return bytes of encoded image
+@traced("encode_raster")
+def encode_raster(width, height, polygons=None, lines=None, format="png", \
+                    scale=1.0, antialias=0, boundry=0, thickness=None, uni_color=None):
+    image = render_image(width, height, polygons, lines, scale, antialias, \
+                            boundry, thickness, uni_color)
+    ok, data = cv2.imencode("." + format, image)
+    if not ok:
+        raise IOError("could not encode " + format)
+    return data.tobytes()
@@ -0,0 +1,110 @@
+import math
+import numpy as np
+from tracing import traced, result_length
+# lowpoly imports this module back as a whole, used at call time
+import lowpoly
+
+'''
+This file contains error driven refinement of point sets. Starting from
+a coarse grid, the image is tessellated, every polygon is compared with
+the source pixels it covers as if filled with their mean color, and the
+worst polygons get a point where their pixels miss that color most.
+Rounds repeat until a polygon budget or an rms color error is reached,
+so detail goes where flat colors miss the image, not where density says
+'''
+
+
+# regular grid of about count points spanning the whole image, image
+# corners and borders included so the tessellation covers every pixel
+# return (N, 2) int32 array of points (x,y)
+def coarse_points(image, count):
+    height, width = image.shape[:2]
+    dist = math.sqrt(width * height / max(count, 4))
+    xs = np.unique(np.linspace(0, width - 1, max(2, int(round(width / dist)) + 1)).round())
+    ys = np.unique(np.linspace(0, height - 1, max(2, int(round(height / dist)) + 1)).round())
+    grid = np.stack(np.meshgrid(xs, ys), axis=2).reshape(-1, 2)
+    return grid.astype(np.int32)
+
+
+# squared error of filling every polygon with its mean color, and where
+# to split it: the centroid of its pixels weighted by their squared
+# distance to that color, or the farthest pixel itself if worst
+# labels is a polygon_label_map, count the number of polygons
+# return ((N,) float64 squared errors, (N, 2) int32 positions (x,y))
+def polygon_errors(image, labels, count, worst=0):
+    labels = labels.ravel()
+    length = count + 1
+    counts = np.maximum(np.bincount(labels, minlength=length), 1)
+    pixels = image.reshape(-1, 3).astype(np.float64)
+    errors = np.zeros(length, dtype=np.float64)
+    distance = np.zeros(len(labels), dtype=np.float64)
+    for i in range(3):
+        channel = pixels[:,i]
+        sums = np.bincount(labels, weights=channel, minlength=length)
+        squares = np.bincount(labels, weights=channel * channel, minlength=length)
+        errors += squares - sums * sums / counts
+        distance += (channel - (sums / counts)[labels]) ** 2
+    errors = np.maximum(errors[1:], 0)
+    width = image.shape[1]
+    if worst:
+        farthest = np.zeros(length, dtype=np.float64)
+        np.maximum.at(farthest, labels, distance)
+        # one of the pixels at the largest distance of every label
+        pixel = np.flatnonzero(distance == farthest[labels])
+        index = np.zeros(length, dtype=np.intp)
+        index[labels[pixel]] = pixel
+        index = index[1:]
+        return errors, np.column_stack((index % width, index // width)).astype(np.int32)
+    weight = np.bincount(labels, weights=distance, minlength=length)[1:]
+    pixel = np.arange(len(labels))
+    xs = np.bincount(labels, weights=distance * (pixel % width), minlength=length)[1:]
+    ys = np.bincount(labels, weights=distance * (pixel // width), minlength=length)[1:]
+    weight = np.maximum(weight, 1e-12)
+    return errors, np.column_stack((xs / weight, ys / weight)).round().astype(np.int32)
+
+
+# int64 key of every integer point (x,y)
+def point_keys(points):
+    return (points[:,0].astype(np.int64) << 32) | points[:,1]
+
+
+# rms color error per pixel and channel of squared polygon errors
+def rms_error(image, errors):
+    return math.sqrt(errors.sum() / max(image.size, 1))
+
+
+# refine points until tessellate(image, points) has about budget polygons
+# or its rms color error is at most max_error, whichever comes first
+# every round adds points to at most step of the polygons, worst first,
+# at the worst pixel if worst, otherwise at the error weighted centroid
+# return (N, 2) int32 array of points (x,y)
+@traced("refine_points", result_length("points"))
+def refine_points(image, tessellate, budget=0, max_error=0, worst=0, step=0.5, \
+                    rounds=64, progress=None):
+    if not budget and not max_error:
+        raise ValueError("refinement needs a polygon budget or an error level")
+    points = coarse_points(image, budget // 32 if budget else 64)
+    for _ in range(rounds):
+        lowpoly.report(progress, "refinement")
+        polygons = tessellate(image, points)
+        # too few distinct points for a single polygon, e.g. a 1x1 image
+        if len(polygons) == 0:
+            break
+        labels = lowpoly.polygon_label_map(image, polygons)
+        errors, positions = polygon_errors(image, labels, len(polygons), worst)
+        if max_error and rms_error(image, errors) <= max_error:
+            break
+        count = int(math.ceil(step * len(polygons)))
+        if budget:
+            # every new point adds about as many polygons as points do so far
+            count = min(count, int((budget - len(polygons)) * len(points) / len(polygons)))
+        order = np.argsort(-errors, kind="stable")
+        keys = point_keys(positions[order[errors[order] > 0]])
+        # positions already taken by a point would not change anything,
+        # the next worst polygons fill in for them
+        _, first = np.unique(keys, return_index=True)
+        first = np.sort(first[~np.isin(keys[first], point_keys(points))])[:max(count, 0)]
+        if len(first) == 0:
+            break
+        points = np.concatenate((points, positions[order[first]]))
+    return points
@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import signal
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import fields
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import numpy as np
+from core import Params, convert
+from raster import RASTER_FORMATS
+
+'''
+This file contains the local conversion server. An asyncio http server on
+localhost or a unix socket hands image bytes to a pool of warm worker
+processes with the pipeline already imported, and streams back svg or
+raster bytes. Requests beyond the workers wait in a bounded queue, a full
+queue is answered with 503, every request has a deadline, and
+GET /metrics reports throughput and latency.
+    POST /convert?mode=Voronoi&cull_pts=5&output=png   body: image bytes
+'''
+
+# type of every Params field, fields defaulting to None take ints
+PARAM_TYPES = {f.name: type(f.default) if f.default is not None else int \
+                for f in fields(Params)}
+
+OUTPUTS = ("svg",) + RASTER_FORMATS
+
+CONTENT_TYPES = {"svg": "image/svg+xml", "jpg": "image/jpeg"}
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", \
+            405: "Method Not Allowed", 413: "Payload Too Large", \
+            500: "Internal Server Error", 503: "Service Unavailable", \
+            504: "Gateway Timeout"}
+
+# bytes written per chunk of a response body
+CHUNK_SIZE = 1 << 16
+
+
+# run once in every worker process, so the first request finds opencv,
+# numpy and the pipeline imported and their code paths warm
+def warm_worker():
+    ys, xs = np.mgrid[0:64, 0:64]
+    image = np.dstack([(xs * 4) ^ (ys * 4)] * 3).astype(np.uint8)
+    for mode in ("Delaunay", "Voronoi", "Tri-Grid"):
+        convert(image, Params(mode=mode, cull_pts=50, seed=0)).data()
+
+
+# convert in a worker process
+# return bytes of output
+def convert_job(data, params):
+    return convert(data, Params(**params)).data()
+
+
+# Params fields of a query string, values converted to field types
+# raise ValueError for unknown fields or bad values
+def parse_params(query):
+    params = {}
+    for name, value in parse_qsl(query, keep_blank_values=True):
+        if name not in PARAM_TYPES:
+            raise ValueError("unknown parameter " + name)
+        params[name] = PARAM_TYPES[name](value)
+    if params.get("output", "svg") not in OUTPUTS:
+        raise ValueError("output must be one of " + ", ".join(OUTPUTS))
+    return params
+
+
+# content type and encoding headers of output in params
+def content_headers(params):
+    output = params.get("output", "svg")
+    headers = {"Content-Type": CONTENT_TYPES.get(output, "image/" + output)}
+    if output == "svg" and params.get("compress"):
+        headers["Content-Encoding"] = "gzip"
+    return headers
+
+
+# counts and recent latencies of finished requests
+class Metrics:
+    def __init__(self, window=1000):
+        self.start = time.monotonic()
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, status, seconds, size=0):
+        self.requests += 1
+        if status == 200:
+            self.completed += 1
+            self.bytes_out += size
+            self.latencies.append(seconds)
+        elif status == 503:
+            self.rejected += 1
+        elif status == 504:
+            self.timeouts += 1
+        else:
+            self.failed += 1
+
+    # latency in ms at quantile q of recent completed requests
+    def latency(self, q):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e3
+
+    def snapshot(self, queued=0, running=0):
+        uptime = time.monotonic() - self.start
+        recent = list(self.latencies)
+        return dict(uptime_s=round(uptime, 3), requests=self.requests, \
+                    completed=self.completed, failed=self.failed, \
+                    rejected=self.rejected, timeouts=self.timeouts, \
+                    queued=queued, running=running, bytes_out=self.bytes_out, \
+                    throughput_per_s=round(self.completed / uptime, 3) if uptime else 0.0, \
+                    latency_ms=dict(mean=round(sum(recent) / len(recent) * 1e3, 3) \
+                                        if recent else 0.0, \
+                                    p50=round(self.latency(0.5), 3), \
+                                    p95=round(self.latency(0.95), 3), \
+                                    p99=round(self.latency(0.99), 3)))
+
+
+# raised with the http status a request is answered with
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# conversion server, jobs worker processes and up to max_queue waiting
+# requests, each request has timeout seconds from arrival to its answer
+class Server:
+    def __init__(self, jobs=None, max_queue=64, timeout=30.0, max_bytes=64 << 20):
+        self.jobs = jobs or os.cpu_count()
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.metrics = Metrics()
+        self.pool = None
+        self.slots = None
+        self.waiting = 0
+        self.running = 0
+
+    # start worker processes and wait until every one is warm
+    async def start_pool(self):
+        loop = asyncio.get_running_loop()
+        self.pool = ProcessPoolExecutor(max_workers=self.jobs, initializer=warm_worker)
+        self.slots = asyncio.Semaphore(self.jobs)
+        await asyncio.gather(*[loop.run_in_executor(self.pool, os.getpid) \
+                                for _ in range(self.jobs)])
+
+    # replace pool once a worker died and broke it, jobs of other requests
+    # failing on the same broken pool find it replaced already
+    def restart_pool(self, broken):
+        if self.pool is not broken:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.pool = ProcessPoolExecutor(max_workers=self.jobs, initializer=warm_worker)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    # run one conversion in the pool, queued behind running ones
+    # a job that outlives its deadline keeps its worker slot until it ends,
+    # worker processes can not be interrupted, so the queue stays honest
+    async def run(self, data, params, deadline):
+        if self.waiting + self.running >= self.jobs + self.max_queue:
+            raise RequestError(503, "queue full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            raise RequestError(504, "timed out in queue")
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        pool = self.pool
+
+        def release(_=None):
+            self.running -= 1
+            self.slots.release()
+
+        try:
+            future = asyncio.get_running_loop().run_in_executor(pool, convert_job, \
+                                                                data, params)
+        except BrokenProcessPool:
+            release()
+            self.restart_pool(pool)
+            raise RequestError(503, "worker pool restarted, retry")
+        future.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), \
+                                            max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise RequestError(504, "timed out in conversion")
+        except ValueError as e:
+            raise RequestError(400, str(e))
+        except BrokenProcessPool:
+            self.restart_pool(pool)
+            raise RequestError(503, "worker crashed, pool restarted, retry")
+
+    # read one http request
+    # return (method, target, headers, body) or None at end of connection
+    async def read_request(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise RequestError(400, "header too large")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise RequestError(400, "bad request line")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0) or 0)
+        if length > self.max_bytes:
+            raise RequestError(413, "image larger than %d bytes" % self.max_bytes)
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    async def respond(self, writer, status, body=b"", headers=None, close=0):
+        head = ["HTTP/1.1 %d %s" % (status, REASONS.get(status, "")), \
+                "Content-Length: %d" % len(body)]
+        head += ["%s: %s" % item for item in (headers or {}).items()]
+        if close:
+            head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        # drain per chunk, so a slow client holds back only its own stream
+        for start in range(0, len(body), CHUNK_SIZE):
+            writer.write(body[start:start + CHUNK_SIZE])
+            await writer.drain()
+        await writer.drain()
+
+    async def error(self, writer, status, message, close=0):
+        await self.respond(writer, status, (message + "\n").encode(), \
+                            {"Content-Type": "text/plain"}, close)
+
+    # answer one request
+    # return status and size of answered body
+    async def handle(self, writer, method, target, body, close):
+        url = urlsplit(target)
+        if url.path == "/metrics":
+            data = json.dumps(self.metrics.snapshot(self.waiting, self.running)).encode()
+            await self.respond(writer, 200, data, {"Content-Type": "application/json"}, \
+                                close)
+            return None, 0
+        if url.path == "/health":
+            await self.respond(writer, 200, b"ok\n", {"Content-Type": "text/plain"}, close)
+            return None, 0
+        if url.path != "/convert":
+            raise RequestError(404, "unknown path " + url.path)
+        if method != "POST":
+            raise RequestError(405, "POST image bytes to /convert")
+        try:
+            params = parse_params(url.query)
+        except ValueError as e:
+            raise RequestError(400, str(e))
+        data = await self.run(body, params, time.monotonic() + self.timeout)
+        await self.respond(writer, 200, data, content_headers(params), close)
+        return 200, len(data)
+
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except RequestError as e:
+                    await self.error(writer, e.status, str(e), close=1)
+                    self.metrics.record(e.status, 0)
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                close = headers.get("connection", "").lower() == "close"
+                start = time.monotonic()
+                try:
+                    status, size = await self.handle(writer, method, target, body, close)
+                except RequestError as e:
+                    status, size = e.status, 0
+                    await self.error(writer, e.status, str(e), close)
+                except Exception as e:
+                    status, size = 500, 0
+                    await self.error(writer, 500, repr(e), close)
+                if status is not None:
+                    self.metrics.record(status, time.monotonic() - start, size)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # serve until stop is set, on a unix socket if path is given,
+    # otherwise on host:port
+    async def serve(self, host="127.0.0.1", port=8765, path=None, ready=None):
+        await self.start_pool()
+        self.metrics = Metrics()
+        if path:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.connection, path)
+        else:
+            server = await asyncio.start_server(self.connection, host, port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        if ready is not None:
+            ready(server)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            self.close()
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+# http connection over a unix socket
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+# client side: convert encoded image bytes on a running server
+# params are Params fields, e.g. mode="Voronoi", output="png"
+# return bytes of output, raise IOError with the server message on failure
+def request(data, host="127.0.0.1", port=8765, path=None, timeout=60, \
+            connection=None, **params):
+    if connection is None:
+        connection = UnixConnection(path, timeout) if path else \
+                        http.client.HTTPConnection(host, port, timeout=timeout)
+    connection.request("POST", "/convert?" + urlencode(params), body=data)
+    response = connection.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise IOError("%d %s" % (response.status, body.decode(errors="replace").strip()))
+    return body
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve conversions from a " \
+                                        "pool of warm worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, \
+                        help="listen on this unix socket instead of host:port")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), \
+                        help="worker processes (default: cpu count)")
+    parser.add_argument("--max-queue", type=int, default=64, \
+                        help="requests waiting for a worker before 503")
+    parser.add_argument("--timeout", type=float, default=30.0, \
+                        help="seconds from arrival to answer before 504")
+    parser.add_argument("--max-bytes", type=int, default=64 << 20, \
+                        help="largest accepted image")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = Server(args.jobs, args.max_queue, args.timeout, args.max_bytes)
+
+    def ready(listening):
+        where = args.socket or "http://%s:%d" % (args.host, args.port)
+        print("serving on %s with %d warm workers" % (where, server.jobs), flush=True)
+
+    asyncio.run(server.serve(args.host, args.port, args.socket, ready))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
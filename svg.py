@@ -4,6 +4,16 @@ Author: Peiyi Hou
 This file contains functions that write dataset into svg
 '''
 
+import gzip
+import io
+import numpy as np
+from polygons import PolygonSet, color_groups
+from tracing import traced, file_size
+
+# polygons of a PolygonSet are formatted this many at a time, so only
+# the strings of one block exist at once
+POLYGON_BLOCK = 4096
+
 
 # return string of xml header
 def svg_header(width, height):
@@ -17,12 +27,92 @@ def svg_header(width, height):
                 <desc>Testing - lowpoly</desc>'''
     return svg_header+size
 
-# return string of a single <polygon>...</polygon>
-def write_polygon(polygons, line=0):
-    polygon_strs = []
+# return string of flattened points "x y x y ..."
+# precision None keeps full repr of each value
+# otherwise values are rounded to precision decimals (0 for integers)
+def format_points(points, precision=None):
+    if hasattr(points, "tolist"):
+        points = points.tolist()
+    if precision is None:
+        return " ".join([str(pos) for pos in points])
+    if precision == 0:
+        return " ".join(["%d" % round(pos) for pos in points])
+    fmt = "%%.%df" % precision
+    return " ".join([fmt % pos for pos in points])
+
+# return list of strings of float32 array values, formatted as format_points
+# except that integral values print as integers when precision is None
+def format_values(values, precision=None):
+    values = np.asarray(values).ravel()
+    if precision is None:
+        integral = values == np.round(values)
+        strings = list(map(str, np.where(integral, values, 0).astype(np.int64).tolist()))
+        for i in np.flatnonzero(~integral).tolist():
+            strings[i] = str(values[i])
+        return strings
+    if precision == 0:
+        return list(map(str, np.round(values.astype(np.float64)).astype(np.int64).tolist()))
+    fmt = "%%.%df" % precision
+    return [fmt % pos for pos in values.tolist()]
+
+# return list of points strings of polygons of one block
+# blocks of integral polygons with equal vertex count, e.g. triangles of
+# integer points, are formatted one "%d %d ..." row at a time
+def format_block(coords, offsets, precision=None):
+    sizes = np.diff(offsets)
+    if len(sizes) and (sizes == sizes[0]).all() and precision in (None, 0) \
+            and (precision == 0 or (coords == np.round(coords)).all()):
+        fmt = " ".join(["%d"] * (2 * int(sizes[0])))
+        rows = np.round(coords).astype(np.int64).reshape(len(sizes), -1).tolist()
+        return [fmt % tuple(row) for row in rows]
+    values = format_values(coords, precision)
+    offsets = ((offsets - offsets[0]) * 2).tolist()
+    return [" ".join(values[offsets[i]:offsets[i+1]]) for i in range(len(sizes))]
+
+# yield tuple (color, points string) of each polygon of a PolygonSet,
+# or of an iterable of PolygonSets, each set formatted as it arrives
+# color is None for a set without colors
+def polygon_set_strings(polygons, precision=None, block=POLYGON_BLOCK):
+    if isinstance(polygons, PolygonSet):
+        polygons = [polygons]
+    for polygon_set in polygons:
+        for start in range(0, len(polygon_set), block):
+            end = min(start + block, len(polygon_set))
+            offsets = polygon_set.offsets[start:end+1]
+            points = format_block(polygon_set.coords[offsets[0]:offsets[-1]], \
+                                    offsets, precision)
+            colors = [None] * (end - start)
+            if polygon_set.colors is not None:
+                colors = polygon_set.colors[start:end].tolist()
+            for color, points_str in zip(colors, points):
+                yield color, points_str
+
+# yield string of a single <polygon>...</polygon> for each polygon of
+# a colored PolygonSet or an iterable of them, same as write_polygon
+def write_polygon_set(polygons, line=0, precision=None):
+    if line:
+        template = '<polygon fill="rgb(254,254,254)" stroke="rgb(1,1,1)" ' \
+                    'stroke-width="1" points="%s"/>'
+        for _, points_str in polygon_set_strings(polygons, precision):
+            yield template % points_str
+        return
+    template = '<polygon fill="rgb(%d,%d,%d)"  points="%s"/>'
+    for color, points_str in polygon_set_strings(polygons, precision):
+        yield template % (color[0], color[1], color[2], points_str)
+
+# yield string of a single <polygon>...</polygon> for each polygon
+# polygons is a colored PolygonSet or an iterable of (color, points)
+# or of colored PolygonSets, e.g. one per tile
+def write_polygon(polygons, line=0, precision=None):
+    if isinstance(polygons, PolygonSet):
+        yield from write_polygon_set(polygons, line, precision)
+        return
     for polygon in polygons:
+        if isinstance(polygon, PolygonSet):
+            yield from write_polygon_set(polygon, line, precision)
+            continue
         color_str = "rgb(%s)"%(",".join([str(clr) for clr in polygon[0]]))
-        points_str = " ".join([str(pos) for pos in polygon[1]])
+        points_str = format_points(polygon[1], precision)
         header = "<polygon fill="
         tail = '"/>'
         stroke_str = ""
@@ -31,40 +121,151 @@ def write_polygon(polygons, line=0):
             color_str = "rgb(254,254,254)"
         polygon_str = header + '"' + color_str + '" '+ stroke_str + ' points="'\
                     + points_str + tail
-        polygon_strs.append(polygon_str)
-    return polygon_strs
+        yield polygon_str
 
-# return string of a single <polygline>...</polyline>
-def write_lines(lines,thickness=1,uni_color = None):
-    line_strs = []
+# yield string of a single <polygline>...</polyline> for each line
+def write_lines(lines,thickness=1,uni_color = None, precision=None):
     for line in lines:
         clr = line[0]
         if uni_color != None:
             clr = uni_color
-        color_str = "rgb(%s)"%(",".join([str(clr) for clr in line[0]]))
+        color_str = "rgb(%s)"%(",".join([str(c) for c in clr]))
         thickness_str = 'stroke-width="%d"'%(thickness)
-        points_str = " ".join([str(pt) for pt in line[1]])
+        points_str = format_points(line[1], precision)
         header = '<polyline fill="RGB(254,254,254)" stroke='
         tail = '"/>'
         line_str = header + '"' + color_str + '" ' + thickness_str + ' points="'\
                     + points_str + tail
-        line_strs.append(line_str)
-    return line_strs
+        yield line_str
+
+
+# snap each channel to nearest multiple of quantize
+# quantize 17 makes every color expressible as short hex #rgb
+# return tuple (r,g,b)
+def quantize_color(color, quantize=1):
+    if quantize <= 1:
+        return tuple(int(clr) for clr in color)
+    return tuple(min(255, int(round(int(clr)/quantize))*quantize) for clr in color)
+
+# return hex string of color, short form #rgb when exact
+def hex_color(color):
+    r, g, b = (int(clr) for clr in color)
+    if r % 17 == 0 and g % 17 == 0 and b % 17 == 0:
+        return "#%x%x%x" % (r//17, g//17, b//17)
+    return "#%02x%02x%02x" % (r, g, b)
 
+# group polygons sharing the same (quantized) fill into one <path>
+# each polygon becomes a "Mx y x y ...Z" subpath
+# css emits a <style> block and refers to fills by class
+# yield string of <style> and each <path>
+def write_paths(polygons, line=0, precision=None, quantize=1, css=0):
+    groups = {}
+    if isinstance(polygons, PolygonSet):
+        polygons = [polygons]
+    for polygon in polygons:
+        if isinstance(polygon, PolygonSet):
+            members = [((254,254,254), slice(None))] if line and len(polygon) else \
+                        color_groups(polygon, quantize)
+            for color, index in members:
+                groups.setdefault(color, []).extend(["M" + points_str + "Z" \
+                    for _, points_str in polygon_set_strings(polygon.take(index), \
+                                                            precision)])
+            continue
+        color = (254,254,254)
+        if not line:
+            color = quantize_color(polygon[0], quantize)
+        subpath = "M" + format_points(polygon[1], precision) + "Z"
+        groups.setdefault(color, []).append(subpath)
+    stroke_str = ""
+    if line:
+        stroke_str = ' stroke="#010101" stroke-width="1"'
+    if css:
+        yield "<style>" + "".join([".c%d{fill:%s}" % (i, hex_color(color)) \
+                        for i, color in enumerate(groups)]) + "</style>"
+    for i, (color, subpaths) in enumerate(groups.items()):
+        fill_str = 'fill="%s"' % hex_color(color)
+        if css:
+            fill_str = 'class="c%d"' % i
+        yield '<path ' + fill_str + stroke_str + ' d="' + "".join(subpaths) + '"/>'
+
+
+# return file extension for plain or gzip compressed svg
+def svg_extension(compress=0):
+    if compress:
+        return ".svgz"
+    return ".svg"
+
+
+# open path for buffered text writing
+# gzip compressed if compress is set, or if path ends with .svgz
+def open_svg(path, compress=None, buffer_size=1<<20):
+    if compress is None:
+        compress = path.endswith(".svgz")
+    if compress:
+        stream = io.BufferedWriter(gzip.open(path, 'wb'), buffer_size)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, 'w', buffering=buffer_size, encoding="utf-8")
 
-# concatennate header, polygons and lines, and write to file
+
+# yield strings of svg document: header, polygons, lines and end tag
+# polygons and lines can be any iterable, e.g. generators
+# group writes one <path> per fill color instead of one <polygon> each
+def svg_document(width, height, polygons=None, lines=None, uni_color=None, \
+                    thickness=None, boundry=0, precision=None, group=0, \
+                    quantize=1, css=0):
+    yield svg_header(width, height)
+    yield '\n'
+    if polygons is not None:
+        elements = write_polygon(polygons, line=boundry, precision=precision)
+        if group:
+            elements = write_paths(polygons, line=boundry, precision=precision, \
+                                    quantize=quantize, css=css)
+        for polygon in elements:
+            yield polygon
+            yield '\n'
+    if lines is not None:
+        for line in write_lines(lines, thickness=thickness or 1, \
+                                uni_color=uni_color, precision=precision):
+            yield line
+            yield '\n'
+    yield "</svg>"
+
+
+# concatennate header, polygons and lines, and stream to file
+# polygons and lines can be any iterable, e.g. generators
+# group writes one <path> per fill color instead of one <polygon> each
+@traced("write_file", file_size(0))
 def write_file(path, width, height, polygons=None, \
-                lines=None, uni_color=None, thickness=None, boundry=0):
-    file = open(path, 'w')
-    file.write(svg_header(width, height))
-    file.write('\n')
-    if polygons:
-        for polygon in write_polygon(polygons,line=boundry):
-            file.write(polygon)
-            file.write('\n')
-    if lines:
-        for line in write_lines(lines):
-            file.write(line)
-            file.write('\n')
-    file.write("</svg>")
-    file.close()
+                lines=None, uni_color=None, thickness=None, boundry=0, \
+                precision=None, compress=None, buffer_size=1<<20, \
+                group=0, quantize=1, css=0):
+    with open_svg(path, compress, buffer_size) as file:
+        for part in svg_document(width, height, polygons, lines, uni_color, \
+                                    thickness, boundry, precision, group, \
+                                    quantize, css):
+            file.write(part)
+
+
+# write svg document as utf-8 into binary stream, e.g. io.BytesIO
+# gzip compressed if compress, writes are batched to about buffer_size
+# bytes, stream is left open
+@traced("write_stream")
+def write_stream(stream, width, height, polygons=None, \
+                    lines=None, uni_color=None, thickness=None, boundry=0, \
+                    precision=None, compress=0, buffer_size=1<<20, \
+                    group=0, quantize=1, css=0):
+    target = gzip.GzipFile(fileobj=stream, mode='wb') if compress else stream
+    chunk = []
+    size = 0
+    for part in svg_document(width, height, polygons, lines, uni_color, \
+                                thickness, boundry, precision, group, \
+                                quantize, css):
+        chunk.append(part)
+        size += len(part)
+        if size >= buffer_size:
+            target.write("".join(chunk).encode("utf-8"))
+            chunk = []
+            size = 0
+    target.write("".join(chunk).encode("utf-8"))
+    if compress:
+        target.close()
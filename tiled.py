@@ -0,0 +1,356 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from lowpoly import *
+from merge import merge_polygons
+from triangulation import circumcenters
+
+'''
+This file contains tiled delaunay and voronoi for images too large to
+process at once. Points are extracted per tile, then each tile is
+triangulated together with the points of a surrounding overlap band and
+only keeps the polygons it owns. Overlap grows until every kept polygon
+is provably the same as in a triangulation of the whole image, so tiles
+stitch without cracks or duplicates. Colored tiles are compact
+PolygonSets, and svg is streamed tile by tile.
+'''
+
+
+# open image for tiled access
+# .npy files are memory mapped so only the tiles in use are read,
+# other formats are decoded by opencv as a whole
+def open_tiled_image(input):
+    if input.endswith(".npy"):
+        return np.load(input, mmap_mode="r")
+    image = cv2.imread(input)
+    if image is None:
+        raise IOError("could not read " + input)
+    return image
+
+
+# split width x height into tile x tile cores
+# return list of (x0, y0, x1, y1)
+def tile_cores(width, height, tile):
+    return [(x, y, min(x + tile, width), min(y + tile, height)) \
+            for y in range(0, height, tile) for x in range(0, width, tile)]
+
+
+# grow rect by margin, clipped to image
+def expand(rect, margin, width, height):
+    return (max(rect[0] - margin, 0), max(rect[1] - margin, 0), \
+            min(rect[2] + margin, width), min(rect[3] + margin, height))
+
+
+# true for points (x, y) inside rect [x0, x1) x [y0, y1)
+def inside(points, rect):
+    return (points[:,0] >= rect[0]) & (points[:,0] < rect[2]) \
+            & (points[:,1] >= rect[1]) & (points[:,1] < rect[3])
+
+
+# sample points of one core from its pixels plus a 1 pixel margin,
+# margin makes sobel at inner tile edges match the whole image
+# return (N, 2) int32 array in image coordinates
+def core_points(window, window_rect, core, cull_pts_perct, cull_sbl_perct, \
+                grey_weighted, weighted, seed, dist, poisson=0):
+    if poisson:
+        points = poisson_points(window, cull_pts_perct, cull_sbl_perct, \
+                                grey_weighted, seed)
+    elif grey_weighted:
+        points = greyscale_points(window, seed=seed, dist=dist)
+    else:
+        points = extract_points(window, cull_sobel_prect=cull_sbl_perct, \
+                                cull_points_perct=cull_pts_perct, \
+                                weighted=weighted, seed=seed)
+    points = points + np.array(window_rect[:2], dtype=np.int32)
+    return points[inside(points, core)]
+
+
+# move integer points off exact pixel positions by a small offset hashed
+# from their coordinates, same in every tile, so cocircular pixel points
+# get the same unambiguous triangulation in all tiles
+# offsets are in [0, 0.1), so jittered points stay inside the image
+# return (N, 2) float32 array
+def jitter(points):
+    points = points.astype(np.int64)
+    h = (points[:,0] * 73856093) ^ (points[:,1] * 19349663)
+    offset = np.column_stack((h % 1009, (h // 1009) % 1013)) / 1013.0
+    return (points + offset * 0.1).astype(np.float32)
+
+
+# subdivision of jittered window points over the whole image rect, so
+# every tile has the outer virtual vertices of a whole image Subdiv2D
+def window_subdiv(points, width, height):
+    return site_subdiv(jitter(points), width, height)
+
+
+# triangles with an outer virtual vertex, which getTriangleList leaves
+# out, from the ring of neighbours around each virtual vertex
+# the outer face of the three virtual vertices is left out
+# return (K, 6) float64 array
+def virtual_triangles(subdiv):
+    outer = [subdiv.getVertex(vertex)[0] for vertex in (1, 2, 3)]
+    rows = []
+    for vertex in (1, 2, 3):
+        point, first = subdiv.getVertex(vertex)
+        ring = []
+        edge = first
+        while True:
+            ring.append(subdiv.edgeDst(edge)[1])
+            edge = subdiv.getEdge(edge, cv2.SUBDIV2D_NEXT_AROUND_ORG)
+            if edge == first:
+                break
+        for a, b in zip(ring, ring[1:] + ring[:1]):
+            if a not in outer or b not in outer:
+                rows.append(point + a + b)
+    return np.array(rows, dtype=np.float64).reshape(-1, 6)
+
+
+# rects covering every (jittered) image point outside window
+def outside_rects(window, width, height):
+    rects = []
+    if window[0] > 0:
+        rects.append((-1, -1, window[0] - 0.5, height))
+    if window[2] < width:
+        rects.append((window[2] - 0.5, -1, width, height))
+    if window[1] > 0:
+        rects.append((-1, -1, width, window[1] - 0.5))
+    if window[3] < height:
+        rects.append((-1, window[3] - 0.5, width, height))
+    return rects
+
+
+# true where disc (center, radius) may hold an image point outside window
+def discs_outside(centers, radius, window, width, height):
+    hits = np.zeros(len(centers), dtype=bool)
+    for x0, y0, x1, y1 in outside_rects(window, width, height):
+        dx = np.clip(centers[:,0], x0, x1) - centers[:,0]
+        dy = np.clip(centers[:,1], y0, y1) - centers[:,1]
+        hits |= dx * dx + dy * dy < radius * radius
+    return hits
+
+
+# true where disc (center, radius) holds one of points outside window
+# points of cores under each disc are checked one by one
+def discs_hold_points(discs, core_arrays, tile, columns, window, width, height):
+    for cx, cy, r in discs:
+        rect = (max(int(cx - r), 0), max(int(cy - r), 0), \
+                min(int(cx + r) + 2, width), min(int(cy + r) + 2, height))
+        if rect[0] >= rect[2] or rect[1] >= rect[3]:
+            continue
+        points = window_points(core_arrays, tile, columns, rect)
+        points = points[~inside(points, window)]
+        if len(points) == 0:
+            continue
+        points = jitter(points).astype(np.float64)
+        if np.any((points[:,0] - cx) ** 2 + (points[:,1] - cy) ** 2 < r * r):
+            return True
+    return False
+
+
+# circumcenters and circumradius of (N, 6) triangle array
+def circumcircles(triangles):
+    corners = triangles.reshape(-1, 3, 2).astype(np.float64)
+    centers = circumcenters(corners)
+    return centers, np.hypot(*(corners[:,0] - centers).T)
+
+
+# true where (N, 6) triangles intersect rect, by separating axes
+def triangles_touch(triangles, rect):
+    xs = triangles[:,0::2]
+    ys = triangles[:,1::2]
+    apart = (xs.max(axis=1) < rect[0]) | (xs.min(axis=1) > rect[2]) \
+            | (ys.max(axis=1) < rect[1]) | (ys.min(axis=1) > rect[3])
+    corners = np.array([(rect[0], rect[1]), (rect[2], rect[1]), \
+                        (rect[2], rect[3]), (rect[0], rect[3])], dtype=np.float64)
+    for i in range(3):
+        px, py = xs[:,i], ys[:,i]
+        nx = ys[:,(i + 1) % 3] - py
+        ny = px - xs[:,(i + 1) % 3]
+        side = nx * (xs[:,(i + 2) % 3] - px) + ny * (ys[:,(i + 2) % 3] - py)
+        proj = nx[:,None] * (corners[:,0] - px[:,None]) \
+                + ny[:,None] * (corners[:,1] - py[:,None])
+        apart |= ((side > 0) & (proj.max(axis=1) < 0)) \
+                | ((side < 0) & (proj.min(axis=1) > 0))
+    return ~apart
+
+
+# triangulate window points and keep triangles owned by core
+# a triangle is owned by the core holding its centroid; triangles over
+# the core are exact unless their circumcircle holds a point outside
+# window, circles that reach outside window are returned for checking
+# return (PolygonSet of triangles, (K, 3) circles to check)
+def tile_triangles(points, window, core, width, height):
+    subdiv = window_subdiv(points, width, height)
+    triangles = np.concatenate((np.asarray(subdiv.getTriangleList(), \
+                                np.float64).reshape(-1, 6), virtual_triangles(subdiv)))
+    triangles = triangles[triangles_touch(triangles, core)]
+    centers, radius = circumcircles(triangles)
+    doubtful = discs_outside(centers, radius, window, width, height)
+    discs = np.column_stack((centers, radius))[doubtful]
+    real = np.all((triangles > -1) & (triangles < max(width, height) + 1), axis=1)
+    centroids = triangles.reshape(-1, 3, 2).mean(axis=1)
+    # snap jittered corners back to their pixel positions
+    triangles = np.round(triangles[real & inside(centroids, core)])
+    return polygons_from_rows(triangles), discs
+
+
+# voronoi facets of core points, triangulated with all window points
+# a facet is exact unless the circle around one of its vertices through
+# its site holds a point outside window, circles that reach outside
+# window are returned for checking
+# return (PolygonSet of facets, (K, 3) circles to check)
+def tile_facets(points, window, core, width, height):
+    subdiv = window_subdiv(points, width, height)
+    facets, centers = subdiv.getVoronoiFacetList([])
+    sites = np.round(centers).reshape(-1, 2)
+    owned = np.flatnonzero(inside(sites, core))
+    if len(owned) == 0:
+        return polygons_from_list([]), np.zeros((0, 3))
+    vertices = np.concatenate([facets[i] for i in owned]).astype(np.float64)
+    counts = [len(facets[i]) for i in owned]
+    site_of = np.repeat(centers[owned].astype(np.float64), counts, axis=0)
+    radius = np.hypot(*(vertices - site_of).T)
+    doubtful = discs_outside(vertices, radius, window, width, height)
+    discs = np.column_stack((vertices, radius))[doubtful]
+    facets = PolygonSet(vertices, np.concatenate(([0], np.cumsum(counts))))
+    return facets.clipped(width, height), discs
+
+
+# points of all cores that intersect window, limited to window
+def window_points(core_arrays, tile, columns, window):
+    points = np.concatenate([core_arrays[r * columns + c] \
+                for r in range(window[1] // tile, (window[3] - 1) // tile + 1) \
+                for c in range(window[0] // tile, (window[2] - 1) // tile + 1)])
+    return points[inside(points, window)]
+
+
+# color polygons of a tile from the window image around them
+# return the PolygonSet with colors, in image coordinates
+def color_tile(window_image, origin, polygons, color_mode):
+    local = polygons.translated(-np.asarray(origin, dtype=np.float32))
+    colored = associate_polygon_with_color(window_image, local, color_mode=color_mode)
+    return polygons.with_colors(colored.colors)
+
+
+# polygons of one tile, colored, run in worker process
+# return (colored PolygonSet, circles to check)
+def tile_job(args):
+    points, window, core, kind, window_image, color_mode, width, height = args
+    if kind == "delaunay":
+        polygons, discs = tile_triangles(points, window, core, width, height)
+    else:
+        polygons, discs = tile_facets(points, window, core, width, height)
+    return color_tile(window_image, window[:2], polygons, color_mode), discs
+
+
+# points of one core, run in worker process
+def core_job(args):
+    window, window_rect, core, index, params = args
+    seed = params["seed"]
+    if seed is not None:
+        seed = [seed, index]
+    return core_points(window, window_rect, core, params["cull_pts_perct"], \
+                        params["cull_sbl_perct"], params["grey_weighted"], \
+                        params["weighted"], seed, params["dist"], params["poisson"])
+
+
+# map fn over jobs in order, keeping at most a few jobs in flight
+def bounded_map(pool, fn, jobs, workers):
+    if pool is None:
+        for job in jobs:
+            yield fn(job)
+        return
+    pending = []
+    for job in jobs:
+        pending.append(pool.submit(fn, job))
+        if len(pending) > workers * 2:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+# window image of rect, read from (memory mapped) image
+def crop(image, rect):
+    return np.ascontiguousarray(image[rect[1]:rect[3], rect[0]:rect[2]])
+
+
+# wrapper function for tiled delaunay or voronoi of a large image
+# tile is the core size in pixels, overlap the initial band around it
+# overlap doubles for a tile until all its polygons are exact
+# jobs > 1 spreads tiles over worker processes
+# output svg streamed tile by tile
+# return output file name
+def draw_tiled(input, kind="delaunay", tile=2048, overlap=64, \
+                cull_pts_perct=5, cull_sbl_perct=100, frame=0, boundry=0, \
+                grey_weighted=0, weighted=0, seed=None, color_mode="center", \
+                precision=None, compress=0, group=0, quantize=1, \
+                out_dir=None, skip_existing=0, jobs=1, progress=None, poisson=0, \
+                merge=0):
+    settings = dict(tile=tile, overlap=overlap, cull_pts_perct=cull_pts_perct, \
+                    cull_sbl_perct=cull_sbl_perct, frame=frame, boundry=boundry, \
+                    grey_weighted=grey_weighted, weighted=weighted, seed=seed, \
+                    color_mode=color_mode, precision=precision, compress=compress, \
+                    group=group, quantize=quantize, poisson=poisson, merge=merge)
+    name = output_name(input, kind, [cull_pts_perct, cull_sbl_perct, "tiled", \
+                        output_key(kind, sorted(settings.items()))], compress, out_dir)
+    if skip_existing and os.path.exists(name):
+        return name
+    image = open_tiled_image(input)
+    height = image.shape[0]
+    width = image.shape[1]
+    dist = max(1, int(min(height, width)/100))
+    if grey_weighted and not poisson:
+        # keep greyscale grid aligned across tiles
+        tile = max(dist, tile // dist * dist)
+    cores = tile_cores(width, height, tile)
+    columns = (width + tile - 1) // tile
+    params = dict(cull_pts_perct=cull_pts_perct, cull_sbl_perct=cull_sbl_perct, \
+                    grey_weighted=grey_weighted, weighted=weighted, seed=seed, \
+                    dist=dist, poisson=poisson)
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        report(progress, "sampling")
+        margin = 0 if grey_weighted and not poisson else 1
+        core_args = ((crop(image, w), w, core, i, params) \
+                        for i, core in enumerate(cores) \
+                        for w in [expand(core, margin, width, height)])
+        core_arrays = list(bounded_map(pool, core_job, core_args, jobs))
+        if frame:
+            points = np.concatenate(core_arrays)
+            frame_points = add_frame_points(points, image, cull_pts_perct, \
+                                            seed=seed)[len(points):]
+            for i, core in enumerate(cores):
+                core_arrays[i] = np.concatenate((core_arrays[i], \
+                                    frame_points[inside(frame_points, core)]))
+
+        def tile_args(core, band):
+            window = expand(core, band, width, height)
+            return (window_points(core_arrays, tile, columns, window), window, \
+                    core, kind, crop(image, window), color_mode, width, height)
+
+        def polygons():
+            report(progress, "triangulation")
+            jobs_args = (tile_args(core, overlap) for core in cores)
+            for core, result in zip(cores, bounded_map(pool, tile_job, jobs_args, jobs)):
+                band = overlap
+                shapes, discs = result
+                while discs_hold_points(discs, core_arrays, tile, columns, \
+                                        expand(core, band, width, height), \
+                                        width, height):
+                    band *= 2
+                    shapes, discs = tile_job(tile_args(core, band))
+                # a tile only holds the polygons of its core, edges on the
+                # seams stay on the outline and still meet the next tile
+                if merge and not boundry:
+                    shapes = merge_polygons(shapes, merge)
+                yield shapes
+
+        report(progress, "writing")
+        write_file(name, width, height, polygons=polygons(), boundry=boundry, \
+                    precision=precision, compress=compress, group=group, \
+                    quantize=quantize)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return name
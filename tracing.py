@@ -0,0 +1,245 @@
+import atexit
+import functools
+import json
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+'''
+This file contains tracing of pipeline stages. Decorated stages record
+wall time, cpu time, tracemalloc peak and element counts while a tracer
+is active, results export as chrome trace json (chrome://tracing or
+ui.perfetto.dev) or as a summary table. With no active tracer a stage
+costs one extra function call.
+Switch on with
+    with tracing.trace("trace.json"):
+        ...
+or by setting VORONECTOR_TRACE=trace.json before start, {pid} in the
+name is replaced by the process id
+'''
+
+TRACE_ENV = "VORONECTOR_TRACE"
+
+_tracer = None
+
+
+# collects finished spans of all threads
+class Tracer:
+    def __init__(self, memory=1):
+        self.memory = memory
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    # open spans of calling thread, as lists [peak, base]
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    # memory peak between start and end of a span, nested spans included
+    # tracemalloc has one peak, so it is reset per span and folded back
+    # into the enclosing span when the span ends
+    def enter_memory(self):
+        stack = self.stack()
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][0] = max(stack[-1][0], peak)
+        tracemalloc.reset_peak()
+        stack.append([current, current])
+
+    def exit_memory(self):
+        stack = self.stack()
+        entry = stack.pop()
+        peak = max(entry[0], tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1][0] = max(stack[-1][0], peak)
+        return peak - entry[1]
+
+    def add(self, name, start, wall, cpu, args):
+        event = dict(name=name, ph="X", pid=os.getpid(), \
+                    tid=threading.get_ident(), \
+                    ts=round((start - self.origin) * 1e6, 3), \
+                    dur=round(wall * 1e6, 3), \
+                    args=dict(cpu_ms=round(cpu * 1e3, 3), **args))
+        with self.lock:
+            self.events.append(event)
+
+    # chrome trace / perfetto json object
+    def chrome(self):
+        with self.lock:
+            events = list(self.events)
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def write_chrome(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome(), f)
+
+    # per stage totals, sorted by wall time
+    # return list of dict with name, calls, wall, cpu, peak and counts
+    def totals(self):
+        stages = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            stage = stages.setdefault(event["name"], \
+                        dict(name=event["name"], calls=0, wall_ms=0.0, \
+                            cpu_ms=0.0, peak_bytes=0, counts={}))
+            stage["calls"] += 1
+            stage["wall_ms"] += event["dur"] / 1e3
+            for key, value in event["args"].items():
+                if key == "cpu_ms":
+                    stage["cpu_ms"] += value
+                elif key == "peak_bytes":
+                    stage["peak_bytes"] = max(stage["peak_bytes"], value)
+                elif isinstance(value, int):
+                    stage["counts"][key] = stage["counts"].get(key, 0) + value
+        return sorted(stages.values(), key=lambda s: -s["wall_ms"])
+
+    # plain text table of totals
+    def summary(self):
+        lines = ["%-32s %6s %11s %11s %10s  %s" % \
+                    ("stage", "calls", "wall ms", "cpu ms", "peak MB", "counts")]
+        for stage in self.totals():
+            counts = " ".join("%s=%d" % item for item in sorted(stage["counts"].items()))
+            peak = "%10.2f" % (stage["peak_bytes"] / 1048576.0) \
+                    if self.memory else "%10s" % "-"
+            lines.append("%-32s %6d %11.3f %11.3f %s  %s" % \
+                            (stage["name"][:32], stage["calls"], stage["wall_ms"], \
+                            stage["cpu_ms"], peak, counts))
+        return "\n".join(lines)
+
+
+# active tracer or None
+def tracer():
+    return _tracer
+
+
+# start tracing, memory also starts tracemalloc
+# return the new tracer
+def enable(memory=1):
+    global _tracer
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _tracer = Tracer(memory)
+    return _tracer
+
+
+# stop tracing
+# return the stopped tracer, or None if tracing was off
+def disable():
+    global _tracer
+    stopped, _tracer = _tracer, None
+    if stopped is not None and stopped.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return stopped
+
+
+# trace everything in the with block
+# chrome trace written to path and summary printed to stream if given
+@contextmanager
+def trace(path=None, memory=1, stream=None):
+    active = enable(memory)
+    try:
+        yield active
+    finally:
+        disable()
+        if path:
+            active.write_chrome(path.format(pid=os.getpid()))
+        if stream is not None:
+            print(active.summary(), file=stream)
+
+
+# record the with block as a span of name, counts may be added to the
+# yielded dict
+@contextmanager
+def span(name, **counts):
+    active = _tracer
+    if active is None:
+        yield counts
+        return
+    if active.memory:
+        active.enter_memory()
+    start = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield counts
+    except BaseException as e:
+        counts["error"] = type(e).__name__
+        raise
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.thread_time() - cpu
+        if active.memory:
+            counts["peak_bytes"] = active.exit_memory()
+        active.add(name, start, wall, cpu, counts)
+
+
+# decorator recording each call of a function as a span of name
+# count(result, *args, **kwargs) returns a dict of element counts
+def traced(name, count=None):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with span(name) as counts:
+                result = function(*args, **kwargs)
+                if count is not None:
+                    counts.update(count(result, *args, **kwargs))
+                return result
+        return wrapper
+    return decorate
+
+
+# count functions for traced
+
+# number of elements in the result, stored as key
+def result_length(key):
+    return lambda result, *args, **kwargs: {key: len(result)}
+
+
+# number of elements in positional argument index, stored as key
+def argument_length(index, key):
+    return lambda result, *args, **kwargs: {key: len(args[index])}
+
+
+# size of the file named by positional argument index, stored as bytes
+def file_size(index=0):
+    def count(result, *args, **kwargs):
+        path = args[index]
+        return {"bytes": os.path.getsize(path)} if os.path.exists(path) else {}
+    return count
+
+
+# tracing switched on by environment, written when the process exits
+def _trace_from_environment():
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        return
+    active = enable()
+
+    def finish():
+        if tracer() is not active:
+            return
+        disable()
+        if active.events:
+            active.write_chrome(path.format(pid=os.getpid()))
+            print(active.summary(), file=sys.stderr)
+
+    # forked worker processes of multiprocessing pools skip atexit, they
+    # start with no spans of their own and write them from a finalizer
+    def forked(active):
+        active.events = []
+        multiprocessing.util.Finalize(None, finish, exitpriority=0)
+
+    atexit.register(finish)
+    multiprocessing.util.register_after_fork(active, forked)
+
+
+_trace_from_environment()
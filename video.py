@@ -0,0 +1,285 @@
+import argparse
+import os
+import sys
+import time
+import cv2
+import numpy as np
+from lowpoly import MODES, sobel, cull_sobel, cull_points, extract_points, \
+                    add_frame_points, delaunay_polygons, voronoi_polygons, \
+                    euclidean_mst, grid_points, grid_polygons, mode_arguments, \
+                    associate_polygon_with_color, output_name, output_key, \
+                    write_output, report
+from core import Params
+from raster import render_image
+from tracing import traced
+from cli import collect_images
+
+'''
+This file contains the video and image sequence mode. Sampled points are
+carried from frame to frame and only resampled in cells whose sobel
+saliency changed, so shapes stay put between frames and are recolored,
+instead of flickering with a fresh random point set per frame
+'''
+
+# fourcc of rendered video per output extension
+VIDEO_CODECS = {"mp4": "mp4v", "avi": "MJPG"}
+
+
+# frames of a video file, an image sequence pattern (e.g. frame_%04d.png)
+# or a directory of images
+# yield BGR uint8 frames
+def read_frames(input):
+    if os.path.isdir(input):
+        for path in collect_images([input]):
+            frame = cv2.imread(path)
+            if frame is not None:
+                yield frame
+        return
+    capture = cv2.VideoCapture(input)
+    if not capture.isOpened():
+        raise IOError("could not open " + input)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+# frames per second of a video, default for image sequences
+def frame_rate(input, default=25.0):
+    if os.path.isdir(input):
+        return default
+    capture = cv2.VideoCapture(input)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps if fps and fps > 0 else default
+
+
+# mean absolute difference of two saliency maps per cell x cell block
+# return (rows, cols) float64 array
+def cell_change(reference, saliency, cell):
+    height, width = saliency.shape
+    rows = -(-height // cell)
+    cols = -(-width // cell)
+    padded = np.zeros((rows * cell, cols * cell), dtype=np.float64)
+    padded[:height, :width] = cv2.absdiff(reference, saliency)
+    sums = padded.reshape(rows, cell, cols, cell).sum(axis=(1, 3))
+    row_pixels = np.minimum(cell, height - np.arange(rows) * cell)
+    col_pixels = np.minimum(cell, width - np.arange(cols) * cell)
+    return sums / np.outer(row_pixels, col_pixels)
+
+
+# point set of a frame sequence, resampled per cell
+# a cell is resampled when the mean saliency change since its points were
+# drawn exceeds change, slow drift therefore adds up until it counts
+# frame pins are drawn once for the first frame and kept
+class FramePoints:
+    def __init__(self, cull_pts_perct=5, cull_sbl_perct=100, weighted=0, \
+                    frame=0, seed=None, cell=16, change=8):
+        self.cull_pts_perct = cull_pts_perct
+        self.cull_sbl_perct = cull_sbl_perct
+        self.weighted = weighted
+        self.frame = frame
+        self.seed = seed
+        self.cell = cell
+        self.change = change
+        self.reference = None
+        self.sampled = None
+        self.pins = None
+
+    # seed of frame index, None stays random
+    def frame_seed(self, index):
+        if self.seed is None:
+            return None
+        return [self.seed, index]
+
+    # cell index of each point
+    def point_cells(self, points, cols):
+        return (points[:,1] // self.cell) * cols + points[:,0] // self.cell
+
+    # carried points and frame pins
+    def points(self):
+        return np.concatenate((self.sampled, self.pins))
+
+    # take saliency of the next frame, resample changed cells
+    # return number of resampled cells, every cell for the first frame
+    def update(self, image, index=0):
+        saliency = sobel(image)
+        if self.reference is None or self.reference.shape != saliency.shape:
+            self.reference = saliency
+            self.sampled = extract_points(image, self.cull_sbl_perct, \
+                                            self.cull_pts_perct, self.weighted, \
+                                            self.frame_seed(index), saliency)
+            self.pins = np.empty((0, 2), dtype=np.int32)
+            if self.frame:
+                self.pins = add_frame_points(self.sampled, image, self.cull_pts_perct, \
+                                                seed=self.frame_seed(index))[len(self.sampled):]
+            return -(-saliency.shape[0] // self.cell) * -(-saliency.shape[1] // self.cell)
+        changed = cell_change(self.reference, saliency, self.cell) > self.change
+        count = int(np.count_nonzero(changed))
+        if count == 0:
+            return 0
+        cols = changed.shape[1]
+        changed = changed.ravel()
+        kept = self.sampled[~changed[self.point_cells(self.sampled, cols)]]
+        candidates = cull_sobel(saliency, self.cull_sbl_perct)
+        candidates = candidates[changed[self.point_cells(candidates, cols)]]
+        weights = None
+        if self.weighted:
+            weights = saliency[candidates[:,1], candidates[:,0]]
+        fresh = cull_points(candidates, self.cull_pts_perct, weights=weights, \
+                            seed=self.frame_seed(index))
+        self.sampled = np.concatenate((kept, fresh))
+        pixels = np.repeat(np.repeat(changed.reshape(-1, cols), self.cell, axis=0), \
+                            self.cell, axis=1)[:saliency.shape[0], :saliency.shape[1]]
+        self.reference = np.where(pixels, saliency, self.reference)
+        return count
+
+
+# uncolored shapes of point set for kind of mode
+def point_shapes(kind, image, points):
+    if kind == "delaunay":
+        return delaunay_polygons(image, points)
+    if kind == "voronoi":
+        return voronoi_polygons(image, points)
+    return euclidean_mst(points, image)
+
+
+# uncolored shapes of modes that do not sample points
+def fixed_shapes(kind, image, arguments):
+    if kind == "grid":
+        return grid_polygons(image, arguments["dist"], arguments["sides"], \
+                                arguments["skew_dist"], arguments.get("voronoi", 0))
+    return euclidean_mst(grid_points(image, arguments["dist"], \
+                                        arguments["skew_dist"]), image)
+
+
+# stylize every frame of input in mode
+# delaunay, voronoi and random tree carry their points between frames and
+# rebuild shapes only when points changed, other modes build shapes once;
+# shapes are recolored from every frame
+# output svg or a raster format writes one file per frame into out_dir,
+# a key of VIDEO_CODECS renders one video file
+# return dict with output name, frames, seconds, fps and rebuilt frames
+@traced("draw_video")
+def draw_video(input, mode="Delaunay", cull_pts=2, cull_sbl=100, dist=10, skew=0, \
+                frame=0, boundry=0, weighted=0, seed=None, color_mode="center", \
+                cell=16, change=8, precision=None, compress=0, group=0, \
+                quantize=1, out_dir=None, output="svg", scale=1.0, antialias=0, \
+                progress=None):
+    kind, arguments = mode_arguments(mode, cull_pts, cull_sbl, dist, skew, frame, \
+                                        0, weighted, seed, color_mode)
+    sampler = None
+    if kind in ("delaunay", "voronoi") or arguments.get("random"):
+        sampler = FramePoints(cull_pts, cull_sbl, weighted, frame, seed, cell, change)
+    if kind == "tree":
+        color_mode = "center"
+    writer = None
+    params = Params(mode, cull_pts, cull_sbl, dist, skew, frame=frame, boundry=boundry, \
+                    weighted=weighted, seed=seed, color_mode=color_mode, \
+                    precision=precision, compress=compress, group=group, \
+                    quantize=quantize, output=output, scale=scale, antialias=antialias)
+    # names of different modes and settings never collide
+    base = [output_key(params, cell, change)]
+    name = output_name(input, mode.lower(), base, 0, out_dir, output)
+    shapes = None
+    frames = rebuilt = 0
+    start = time.perf_counter()
+    try:
+        for index, image in enumerate(read_frames(input)):
+            report(progress, "frame")
+            if sampler is not None:
+                if sampler.update(image, index) or shapes is None:
+                    shapes = point_shapes(kind, image, sampler.points())
+                    rebuilt += 1
+            elif shapes is None:
+                shapes = fixed_shapes(kind, image, arguments)
+                rebuilt += 1
+            colored = associate_polygon_with_color(image, shapes, color_mode)
+            polygons, lines = (None, colored) if kind == "tree" else (colored, None)
+            height, width = image.shape[:2]
+            if output in VIDEO_CODECS:
+                canvas = render_image(width, height, polygons, lines, scale, \
+                                        antialias, boundry)
+                if writer is None:
+                    writer = cv2.VideoWriter(name, \
+                                cv2.VideoWriter_fourcc(*VIDEO_CODECS[output]), \
+                                frame_rate(input), (canvas.shape[1], canvas.shape[0]))
+                    if not writer.isOpened():
+                        raise IOError("could not write " + name)
+                writer.write(canvas)
+            else:
+                write_output(output_name(input, mode.lower(), base + ["%05d" % index], \
+                                            compress, out_dir, output), \
+                                width, height, polygons=polygons, lines=lines, \
+                                output=output, boundry=boundry, precision=precision, \
+                                compress=compress, group=group, quantize=quantize, \
+                                scale=scale, antialias=antialias)
+            frames += 1
+    finally:
+        if writer is not None:
+            writer.release()
+    seconds = time.perf_counter() - start
+    if output not in VIDEO_CODECS:
+        name = output_name(input, mode.lower(), base + ["%05d"], compress, out_dir, \
+                            output)
+    return dict(output=name, frames=frames, seconds=seconds, \
+                fps=frames / seconds if seconds > 0 else 0.0, rebuilt=rebuilt)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Stylize a video or image " \
+                                        "sequence frame by frame")
+    parser.add_argument("input", help="video file, image sequence pattern " \
+                        "(e.g. frame_%%04d.png) or directory of images")
+    parser.add_argument("-m", "--mode", default="Delaunay", choices=MODES)
+    parser.add_argument("-o", "--out-dir", default=".")
+    parser.add_argument("--output", default="mp4", \
+                        choices=sorted(VIDEO_CODECS) + ["svg", "png", "jpg"], \
+                        help="video format, or format of one file per frame")
+    parser.add_argument("--density", type=int, default=2, \
+                        help="percentage of edge points kept")
+    parser.add_argument("--threshold", type=int, default=100, \
+                        help="sobel threshold in [0 - 255]")
+    parser.add_argument("--grid-size", type=int, default=10)
+    parser.add_argument("--skew", type=int, default=0)
+    parser.add_argument("--pin-frame", action="store_true")
+    parser.add_argument("--edge-only", action="store_true")
+    parser.add_argument("--weighted", action="store_true", \
+                        help="sample edge points by gradient magnitude")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--color-mode", default="center", \
+                        choices=["center", "box", "mean", "rms"])
+    parser.add_argument("--cell", type=int, default=16, \
+                        help="size of cells resampled on their own")
+    parser.add_argument("--change", type=float, default=8, \
+                        help="mean sobel change of a cell that resamples it")
+    parser.add_argument("--precision", type=int, default=None)
+    parser.add_argument("--svgz", action="store_true")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--antialias", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.out_dir, exist_ok=True)
+    stats = draw_video(args.input, args.mode, cull_pts=args.density, \
+                        cull_sbl=args.threshold, dist=args.grid_size, skew=args.skew, \
+                        frame=int(args.pin_frame), boundry=int(args.edge_only), \
+                        weighted=int(args.weighted), seed=args.seed, \
+                        color_mode=args.color_mode, cell=args.cell, \
+                        change=args.change, precision=args.precision, \
+                        compress=int(args.svgz), out_dir=args.out_dir, \
+                        output=args.output, scale=args.scale, \
+                        antialias=int(args.antialias))
+    print("%d frames (%d rebuilt) in %.3fs, %.2f fps -> %s" % (stats["frames"], \
+            stats["rebuilt"], stats["seconds"], stats["fps"], stats["output"]))
+    return 0 if stats["frames"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())